@@ -4,3 +4,7 @@ import sys
 def child_exit(server, worker):
     print(f"gunicorn worker {worker.pid} has exited", file=sys.stderr, flush=True)
     multiprocess.mark_process_dead(worker.pid)
+    # connection_budget_files only imports the standard library; importing config here would
+    # install its SIGUSR1 handler in the master, which then would not forward SIGUSR1 to the workers
+    from lib_python.connection_budget_files import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -1,20 +1,31 @@
-import asyncio, time
+import asyncio, random, time
 from   abc import ABC, abstractmethod
 from   io  import StringIO
 import pandas as pd
+from   prometheus_client import Counter
 from   . import config
 
+_server_aborts_counter = Counter('wt_query_server_aborts_total',
+    'queries that timed out and were aborted in the database, not just abandoned by the client', ['resource_id'])
+
 class BaseDbConnection(ABC):
     _next_id = 1
     _lock    = asyncio.Lock()
 
     def __init__(self, resource_id: str):
-        self.conn_id           = 0
-        self.resource_id       = resource_id
-        self.uses              = 0
-        self.created_time_mono = time.monotonic()
-        self.is_open           = False
-        self.usage_duration    = 0
+        self.conn_id            = 0
+        self.resource_id        = resource_id
+        self.uses               = 0
+        self.created_time_mono  = time.monotonic()
+        self.is_open            = False
+        self.usage_duration     = 0
+        self.acquired_time_mono = 0  # when the connection was last acquired from the pool
+        self.last_used_time_mono = self.created_time_mono  # when last released or successfully pinged
+        # random factors that spread out when connections expire, see max_age() and max_uses()
+        self.max_age_jitter     = random.random()
+        self.max_uses_jitter    = random.random()
+        self.replacement_requested = False  # set by the pool when it requests a replacement
+        self.server_aborts_counter = _server_aborts_counter.labels(resource_id)
 
     def __str__(self):
         age        = int(time.monotonic() - self.created_time_mono)
@@ -60,18 +71,77 @@ class BaseDbConnection(ABC):
         results.seek(0)
         return results
 
+    @abstractmethod
+    async def _ping(self):
+        'runs a cheap round trip to the DB; raises an exception if the connection is not usable'
+        pass
+
+    async def ping(self, timeout=None):
+        ''' Returns True if the connection is alive. If it is not, the connection is closed
+            and False is returned. '''
+        timeout = timeout or config.get_int(f'{self.resource_id}__db_conn_ping_timeout')
+        try:
+            await asyncio.wait_for(self._ping(), timeout)
+            self.last_used_time_mono = time.monotonic()
+            return True
+        except Exception:
+            try:
+                await self.close()
+            except Exception:
+                self.is_open = False  # the connection is likely already broken
+            return False
+
     @abstractmethod
     async def execute_query(self, query:str, results_as='psv', header=False, timeout=None):
         # subcclasses must update self.usage_duration
         pass
 
+    @abstractmethod
+    def fetch_batches(self, query:str, batch_size=None, timeout=None):
+        ''' async generator that yields (columns, rows) tuples, up to batch_size rows at a time,
+            as rows are fetched from the DB; the first batch is always yielded, even if it is empty '''
+        # subcclasses must update self.usage_duration
+        pass
+
+    def server_side_timeouts(self):
+        'True if query timeouts are also enforced by the database, so a query stops when it times out'
+        return config.getbool(f'{self.resource_id}__db_server_side_timeouts')
+
+    def client_timeout(self, timeout):
+        ''' the timeout to use for asyncio.wait_for(); if the database enforces the timeout, the
+            client waits a little longer (<resource_id>__db_server_timeout_grace secs) so the
+            database can abort the query first '''
+        if self.server_side_timeouts():
+            return timeout + config.get_float(f'{self.resource_id}__db_server_timeout_grace')
+        return timeout
+
     def reset_usage_duration(self):
         self.usage_duration = 0
 
+    def max_age(self):
+        ''' db_conn_max_age reduced by a random amount of up to db_conn_max_age_jitter (a fraction),
+            so connections that were opened at the same time do not all expire at the same time '''
+        jitter = config.get_float(f'{self.resource_id}__db_conn_max_age_jitter') * self.max_age_jitter
+        return config.get_eval(f'{self.resource_id}__db_conn_max_age') * (1 - jitter)
+
+    def max_uses(self):
+        'db_conn_max_uses reduced by a random amount of up to db_conn_max_uses_jitter (a fraction)'
+        jitter = config.get_float(f'{self.resource_id}__db_conn_max_uses_jitter') * self.max_uses_jitter
+        return max(1, round(config.get_int(f'{self.resource_id}__db_conn_max_uses') * (1 - jitter)))
+
+    def expiry_time_mono(self):
+        'monotonic time at which the connection reaches its max age'
+        return self.created_time_mono + self.max_age()
+
     def is_expired(self):
+        return self.uses >= self.max_uses() or time.monotonic() > self.expiry_time_mono()
+
+    def is_expiring(self):
+        ''' returns True if the connection will expire after its next use or within
+            db_conn_replace_ahead seconds, so a replacement can be opened before it is closed '''
         age = time.monotonic() - self.created_time_mono
-        return (self.uses == config.get_int( f'{self.resource_id}__db_conn_max_uses') or
-                age        > config.get_eval(f'{self.resource_id}__db_conn_max_age'))
+        return (self.uses + 1 >= self.max_uses() or
+                age + config.get_int(f'{self.resource_id}__db_conn_replace_ahead') > self.max_age())
 
     def increment_use(self):
         self.uses += 1
@@ -0,0 +1,112 @@
+''' Accept-Encoding negotiated response compression (zstd or gzip). The response body is compressed
+    incrementally, chunk by chunk, so streamed responses stay streamed. '''
+import time, zlib
+from   fastapi  import Request, Response
+from   .shared  import compression_cpu_counter, compression_in_bytes_counter, compression_out_bytes_counter
+from   .        import config
+try:
+    import zstandard  # optional, only needed for zstd compression
+except ImportError:
+    zstandard = None
+
+# media types that are already compressed
+_UNCOMPRESSIBLE_MEDIA_TYPES = ('application/vnd.apache.parquet',)
+
+def choose_encoding(accept_encoding:str):
+    ''' returns the first encoding in config compression_encodings that the client accepts (q > 0),
+        or None if the response should not be compressed '''
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.strip().lower()] = q
+    for encoding in config.get('compression_encodings').split():
+        if encoding == 'zstd' and zstandard is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+class _Compressor:
+    def __init__(self, encoding:str):
+        if encoding == 'zstd':
+            self.compressobj = zstandard.ZstdCompressor(
+                level=config.get_int('compression_zstd_level')).compressobj()
+            self.sync_flush  = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # wbits=31 writes a gzip header and trailer
+            self.compressobj = zlib.compressobj(config.get_int('compression_gzip_level'), zlib.DEFLATED, 31)
+            self.sync_flush  = zlib.Z_SYNC_FLUSH
+
+    def compress(self, chunk:bytes) -> bytes:
+        'compresses and flushes a chunk, so the client can decompress it without waiting for the next one'
+        return self.compressobj.compress(chunk) + self.compressobj.flush(self.sync_flush)
+
+    def finish(self) -> bytes:
+        return self.compressobj.flush()
+
+async def _iterate(chunks, exc=None):
+    for chunk in chunks:
+        yield chunk
+    if exc:
+        raise exc
+
+async def _compressed_body_iterator(head:list[bytes], body_iterator, encoding:str, endpoint:str):
+    compressor = _Compressor(encoding)
+    cpu_time   = 0
+    in_bytes   = out_bytes = 0
+    def compress(chunk, finish=False):
+        nonlocal cpu_time, in_bytes, out_bytes
+        start_time = time.thread_time()  # CPU time of the event loop thread, which does the compression
+        compressed = compressor.finish() if finish else compressor.compress(chunk)
+        cpu_time  += time.thread_time() - start_time
+        in_bytes  += len(chunk)
+        out_bytes += len(compressed)
+        return compressed
+    try:
+        for chunk in head:
+            yield compress(chunk)
+        async for chunk in body_iterator:
+            yield compress(chunk)
+        yield compress(b'', finish=True)
+    finally:
+        await body_iterator.aclose()
+        compression_cpu_counter      .labels(endpoint, encoding).inc(cpu_time)
+        compression_in_bytes_counter .labels(endpoint, encoding).inc(in_bytes)
+        compression_out_bytes_counter.labels(endpoint, encoding).inc(out_bytes)
+
+async def compress_response(request:Request, response:Response):
+    ''' Compresses the response body if the client accepts one of the compression_encodings and the
+        body is at least compression_min_size bytes. Since the headers must be set before the body is
+        sent, the first chunks of the body are read here, until compression_min_size bytes have been
+        read or the body ends. '''
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    if (not encoding or 'content-encoding' in response.headers or
+            response.headers.get('content-type', '').startswith(_UNCOMPRESSIBLE_MEDIA_TYPES)):
+        return
+    body_iterator = response.body_iterator
+    min_size      = config.get_int('compression_min_size')
+    head, size    = [], 0
+    try:
+        while size < min_size:
+            chunk = await anext(body_iterator)
+            head.append(chunk)
+            size += len(chunk)
+    except StopAsyncIteration:
+        response.body_iterator = _iterate(head)  # too small to be worth compressing
+        return
+    except Exception as e:
+        # e.g., a streamed query failed; raise it while the body is sent, as it would have been
+        response.body_iterator = _iterate(head, e)
+        return
+    del response.headers['content-length']
+    response.headers['content-encoding'] = encoding
+    response.headers.add_vary_header('Accept-Encoding')
+    response.body_iterator = _compressed_body_iterator(head, body_iterator, encoding, request.url.path)
@@ -59,6 +59,10 @@ def get_int(key:str):
     with lock:
         return config.getint(main_section, key)
 
+def get_float(key:str):
+    with lock:
+        return config.getfloat(main_section, key)
+
 def get_eval(key:str):
     'only numbers and math operators are allowed in the expression'
     with lock:
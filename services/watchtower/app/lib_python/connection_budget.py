@@ -0,0 +1,76 @@
+''' A per-resource connection budget that is shared by all of the gunicorn workers, so the total
+    number of DB connections to a resource is capped no matter how many workers are running.
+    Like the prometheus client in multiprocess mode, the state is kept in a file in
+    PROMETHEUS_MULTIPROC_DIR, one file per resource_id. An exclusive file lock (flock) on a
+    separate lock file is held while the state is read and updated, which only happens when a
+    connection is opened or closed; a worker that checks if it should give up an idle connection
+    only reads the state, under a shared lock.
+    The new state is written to a temp file that then replaces the state file, so a worker that
+    is killed mid-write cannot leave a partial file behind. The methods do blocking file I/O, so
+    async code should call them with asyncio.to_thread(). '''
+import fcntl, os, time
+import psutil
+from   .connection_budget_files import budget_dir, read_state, write_state
+from   .logging import log
+
+def _read_state(path:str):
+    try:
+        return read_state(path)
+    except ValueError:
+        # should not happen, since the file is replaced atomically; start over rather than fail
+        # every update. The counts of the other workers are lost until they release connections.
+        log.error('dbconn-budget', 'connection budget file is not valid JSON, resetting it', path=path)
+        return {}
+
+class ConnectionBudget:
+    def __init__(self, resource_id:str):
+        self.resource_id = resource_id
+        self.path        = os.path.join(budget_dir(), f'wt_conn_budget_{resource_id}.json')
+
+    def _update(self, func):
+        ''' calls func(state, pid) with the file lock held and saves the (possibly modified) state.
+            state['conns'] is {pid: open connection count} and state['wants'] is
+            {pid: time a connection was last denied}. '''
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+            state = _read_state(self.path)
+            state.setdefault('conns', {})
+            state.setdefault('wants', {})
+            pid = str(os.getpid())
+            for pids in state.values():
+                # in case a worker was killed without the child_exit hook running
+                for dead_pid in [p for p in pids if p != pid and not psutil.pid_exists(int(p))]:
+                    del pids[dead_pid]
+            result = func(state, pid)
+            write_state(self.path, state)
+            return result
+
+    def try_reserve(self, max_connections:int):
+        ''' reserves one connection for this worker if fewer than max_connections are open across
+            all workers; otherwise records that this worker wants a connection and returns False '''
+        def reserve(state, pid):
+            if sum(state['conns'].values()) >= max_connections:
+                state['wants'][pid] = time.time()
+                return False
+            state['conns'][pid] = state['conns'].get(pid, 0) + 1
+            state['wants'].pop(pid, None)
+            return True
+        return self._update(reserve)
+
+    def release(self):
+        'gives back one connection, after it was closed or could not be opened'
+        def release(state, pid):
+            state['conns'][pid] = max(state['conns'].get(pid, 0) - 1, 0)
+        self._update(release)
+
+    def wanted_by_others(self, since:float):
+        ''' returns True if another worker was denied a connection after time.time() value since.
+            This only reads the state, under a shared lock, so it does not rewrite the file or
+            check for dead pids; the wants of a worker that died age out, since only recent ones
+            count. '''
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)  # released when the file is closed
+            state = _read_state(self.path)
+        pid = str(os.getpid())
+        return any(want_time >= since for want_pid, want_time in state.get('wants', {}).items()
+                   if want_pid != pid)
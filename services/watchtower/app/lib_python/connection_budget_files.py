@@ -0,0 +1,38 @@
+''' The state files of the connection budget (see connection_budget.py). This module only imports
+    the standard library, so the gunicorn master can import it in the child_exit hook without
+    pulling in config, which installs a SIGUSR1 handler, or logging. '''
+import fcntl, glob, json, os, tempfile
+
+def budget_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or tempfile.gettempdir()
+
+def read_state(path:str):
+    'returns the state in the file at path, or {} if there is no file; raises ValueError if it is not valid JSON'
+    try:
+        with open(path) as f:
+            return json.loads(f.read() or '{}')
+    except FileNotFoundError:
+        return {}
+
+def write_state(path:str, state:dict):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.wt_conn_budget_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def mark_process_dead(pid:int):
+    'releases the connections of a worker that exited; call this from the gunicorn child_exit hook'
+    for path in glob.glob(os.path.join(budget_dir(), 'wt_conn_budget_*.json')):
+        with open(f'{path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+            try:
+                state = read_state(path)
+            except ValueError:
+                continue  # the next update in a worker logs and resets it
+            for pids in state.values():
+                pids.pop(str(pid), None)
+            write_state(path, state)
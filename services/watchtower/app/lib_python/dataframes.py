@@ -0,0 +1,39 @@
+''' Builds pandas DataFrames column by column, as batches of rows are fetched from the DB, rather
+    than converting the entire result set to a list of row tuples and then calling
+    pd.DataFrame.from_records(), which has to infer the type of every value. '''
+import numpy as np
+import pandas as pd
+
+class DataFrameBuilder:
+    ''' Fills one NumPy array per column. dtypes maps column names to NumPy dtypes--e.g., 'int64',
+        'float64', 'datetime64[s]'. Columns without a dtype hint, and columns whose values do not
+        fit their hint (e.g., a NULL in an integer column), are stored as object arrays. '''
+    def __init__(self, columns:list[str], dtypes:dict=None, capacity=1024):
+        dtypes       = dtypes or {}
+        self.columns = columns
+        self.arrays  = [np.empty(capacity, np.dtype(dtypes.get(column, object))) for column in columns]
+        self.size    = 0
+
+    def append(self, rows):
+        if not rows:
+            return
+        end = self.size + len(rows)
+        if end > len(self.arrays[0]):
+            capacity = max(end, 2 * len(self.arrays[0]))
+            self.arrays = [self._resized(array, capacity) for array in self.arrays]
+        for i, values in enumerate(zip(*rows)):
+            try:
+                self.arrays[i][self.size:end] = values
+            except (TypeError, ValueError):
+                self.arrays[i] = self.arrays[i].astype(object)
+                self.arrays[i][self.size:end] = values
+        self.size = end
+
+    def _resized(self, array, capacity):
+        resized = np.empty(capacity, array.dtype)
+        resized[:self.size] = array[:self.size]
+        return resized
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({column: array[:self.size] for column, array in zip(self.columns, self.arrays)},
+                            copy=False)
@@ -1,10 +1,11 @@
-import asyncio, time
+import asyncio, heapq, itertools, math, time
 from   prometheus_client   import Counter, Gauge, Histogram
 from   .logging            import log, parse_kv_pairs
 from   .exceptions         import AppTimeoutError, DatabaseError, WithDetailsError
 from   .base_db_connection import BaseDbConnection
+from   .connection_budget  import ConnectionBudget
 from   .shared             import BACKGROUND_TASK_NAME_PREFIX, get_cid, shutdown_event
-from   .                   import config
+from   .                   import config, deadlines
 
 _created_conn_counter        = Counter(f'wt_created_connections_total',
     'total number of connections created', ['resource_id'])
@@ -18,6 +19,14 @@ _conn_creation_error_counter = Counter(f'wt_conn_creation_errors_total',
     'total number of connection creation errors', ['resource_id', 'error_type'])
 _conn_acquire_error_counter  = Counter(f'wt_conn_acquire_errors_total',
     'total number of connection acquire errors', ['resource_id'])
+_deferred_recycle_counter    = Counter(f'wt_deferred_conn_recycles_total',
+    'total number of times an expired connection was kept because of the recycle limit', ['resource_id'])
+_budget_denial_counter      = Counter(f'wt_conn_budget_denials_total',
+    'total number of times a connection was not opened because the global budget was used up', ['resource_id'])
+_budget_shed_counter        = Counter(f'wt_conn_budget_sheds_total',
+    'total number of idle connections closed so another worker could open one', ['resource_id'])
+_ping_failure_counter       = Counter(f'wt_conn_ping_failures_total',
+    'total number of connections that failed a liveness ping', ['resource_id'])
 _conn_gauge                  = Gauge(  f'wt_open_connections',
     'number of open connections',           ['resource_id'], multiprocess_mode='livesum')
 _pooled_conn_gauge           = Gauge(  f'wt_pooled_connections',
@@ -26,7 +35,12 @@ _last_conn_created_time_gauge = Gauge(f'wt_last_conn_created_time_seconds',
     'time the last connection was created', ['resource_id'], multiprocess_mode='mostrecent')
 _last_conn_created_error_time_gauge = Gauge(f'wt_last_conn_created_error_time_seconds',
     'time the last connection creation error occurred', ['resource_id'], multiprocess_mode='mostrecent')
+_target_size_gauge           = Gauge(  f'wt_pool_target_connections',
+    'number of connections the pool autoscaler is targeting', ['resource_id'], multiprocess_mode='livesum')
 # use histograms so we can aggregate across all resource_ids
+_ping_hist         = Histogram(f'wt_conn_ping_duration_seconds',
+    'time to ping a connection to check that it is alive', ['resource_id'],
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
 _acquire_conn_hist = Histogram(f'wt_acquire_connection_duration_seconds',
     'time to acquire a connection', ['resource_id'],
     buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10])
@@ -34,6 +48,40 @@ _conn_usage_hist   = Histogram(f'wt_connection_usage_duration_seconds',
     'how long a connection was used to service a request', ['resource_id'],
     # you may want to adjust these buckets
     buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20])
+_conn_hold_hist    = Histogram(f'wt_connection_hold_duration_seconds',
+    'how long a connection was held (acquired until released) by a request', ['resource_id'],
+    # you may want to adjust these buckets
+    buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20, 60])
+
+class PoolIntervalStats:
+    'connection acquire/release stats for one autoscale interval'
+    def __init__(self, in_use:int):
+        self.acquires      = 0
+        self.releases      = 0
+        self.wait_duration = 0       # sum of the acquire wait durations
+        self.hold_duration = 0       # sum of the acquire-to-release durations
+        self.peak_in_use   = in_use  # max connections in use at the same time
+
+class ConnectionQueue(asyncio.Queue):
+    'an asyncio.Queue that also allows an idle connection to be removed, e.g., when it expires'
+    def remove(self, db_conn:BaseDbConnection):
+        'removes db_conn if it is in the queue; returns False if it is not (e.g., it is in use)'
+        try:
+            self._queue.remove(db_conn)
+        except ValueError:
+            return False
+        return True
+
+    def remove_idle(self, idle_time:float):
+        ''' removes and returns the connection that has been idle the longest, if it has not been
+            used for at least idle_time seconds; otherwise returns None '''
+        if not self._queue:
+            return None
+        db_conn = min(self._queue, key=lambda db_conn: db_conn.last_used_time_mono)
+        if time.monotonic() - db_conn.last_used_time_mono < idle_time:
+            return None
+        self._queue.remove(db_conn)
+        return db_conn
 
 class DbConnectionPool:
     ''' a pool of DB connections for a single resource_id '''
@@ -42,24 +90,50 @@ class DbConnectionPool:
     def __init__(self, resource_id: str, conn_class:BaseDbConnection, conn_params:dict):
         self.resource_id    = resource_id
         max_connections     = config.get_int(f'{resource_id}__db_max_conn_pool_size')
-        self.pool           = asyncio.Queue(max_connections)
+        # the pool is not bounded by max_connections, since expiring connections are replaced
+        # before they are closed; conn_count is used to limit the number of connections
+        self.pool           = ConnectionQueue()
         self.add_conn_queue = asyncio.Queue(max_connections)
         self.lock           = asyncio.Lock()
         self.conn_count     = 0  # same count as conn_guage
         self.conn_class     = conn_class
         self.conn_params    = conn_params
         self.consecutive_create_conn_errors = 0
+        self.creating_conn_count   = 0      # connections currently being opened
+        self.create_conn_condition = asyncio.Condition()
+        self.create_conn_tasks     = set()  # tasks that are opening connections
+        self.retry_after_time_mono = 0      # no connections are opened before this time
+        self.acquire_stats         = PoolIntervalStats(0)
+        self.target_size           = config.get_int(f'{resource_id}__db_min_conn_pool_size')
+        # expiring connections whose replacements have been requested, but that are not closed yet
+        self.pending_replacements  = 0
+        self.recycle_interval_start_mono = 0
+        self.recycle_count               = 0
+        # (expiry_time_mono, seq, db_conn) entries, see expire_connections()
+        self.expiry_heap                 = []
+        self.expiry_seq                  = itertools.count()  # tie-breaker for equal expiry times
+        self.expiry_heap_changed         = asyncio.Event()
+        self.budget                      = ConnectionBudget(resource_id)  # shared by all workers
+        self.budget_reserved             = 0  # connections this pool reserved from the budget
+        self.budget_tasks                = set()  # budget releases that are still running
         self.created_conn_counter               = _created_conn_counter              .labels(resource_id)
         self.closed_conn_counter                = _closed_conn_counter               .labels(resource_id)
         self.pool_empty_counter                 = _pool_empty_counter                .labels(resource_id)
         self.pool_exhausted_counter             = _pool_exhausted_counter            .labels(resource_id)
         self.conn_acquire_error_counter         = _conn_acquire_error_counter        .labels(resource_id)
+        self.deferred_recycle_counter           = _deferred_recycle_counter          .labels(resource_id)
+        self.budget_denial_counter              = _budget_denial_counter             .labels(resource_id)
+        self.budget_shed_counter                = _budget_shed_counter               .labels(resource_id)
+        self.ping_failure_counter               = _ping_failure_counter              .labels(resource_id)
+        self.ping_hist                          = _ping_hist                         .labels(resource_id)
         self.conn_gauge                         = _conn_gauge                        .labels(resource_id)
         self.pooled_conn_gauge                  = _pooled_conn_gauge                 .labels(resource_id)
         self.last_conn_created_time_gauge       = _last_conn_created_time_gauge      .labels(resource_id)
         self.last_conn_created_error_time_gauge = _last_conn_created_error_time_gauge.labels(resource_id)
         self.acquire_conn_hist                  = _acquire_conn_hist                 .labels(resource_id)
         self.conn_usage_hist                    = _conn_usage_hist                   .labels(resource_id)
+        self.conn_hold_hist                     = _conn_hold_hist                    .labels(resource_id)
+        self.target_size_gauge                  = _target_size_gauge                 .labels(resource_id)
         # initialize children for metrics that have more than one label
         _conn_creation_error_counter.labels(resource_id, 'timeout')
         _conn_creation_error_counter.labels(resource_id, 'other')
@@ -77,10 +151,12 @@ class DbConnectionPool:
             self.conn_gauge.dec()
             self.pooled_conn_gauge.dec()
             self.closed_conn_counter.inc()
+            self.release_budget()
 
     async def acquire_connection(self, timeout=None):
-        ''' Returns a connection from the pool.
+        ''' Returns a connection from the pool, waiting at most until the request deadline.
             If a connection cannot be obtained, an AppTimeoutError is raised. ''' 
+        deadlines.admit(self.resource_id, 'connection')
         start_time    = time.monotonic()
         conn_obtained = False
         async with self.lock:
@@ -96,58 +172,238 @@ class DbConnectionPool:
                     log.debug('dbpool-exhausted', 'pool exhausted', resource_id=f'{self.resource_id}', cid=get_cid())
                     self.pool_exhausted_counter.inc()
         if not conn_obtained:
-            timeout = timeout or config.get_int(f'{self.resource_id}__db_conn_pool_acquire_timeout')
-            try:
-                # wait for a connection to be put into the pool, which might not happen
-                # before the timeout
-                db_conn:BaseDbConnection = await asyncio.wait_for(self.pool.get(), timeout)
-                self.pooled_conn_gauge.dec()
-            except asyncio.TimeoutError as e:
-                msg = f'{timeout}-sec timeout waiting for a pooled connection'
-                self.conn_acquire_error_counter.inc()
-                # str(e) is empty, so don't add log_kv_pairs below
-                raise AppTimeoutError(f'{msg} for {self.resource_id}', log_msg=msg,
-                                      log_kv_pairs=f'resource_id={self.resource_id}')
-        self.acquire_conn_hist.observe(round(time.monotonic() - start_time, 3))
+            timeout = deadlines.bounded_timeout(
+                timeout or config.get_int(f'{self.resource_id}__db_conn_pool_acquire_timeout'))
+            while not conn_obtained:
+                try:
+                    # wait for a connection to be put into the pool, which might not happen
+                    # before the timeout
+                    db_conn:BaseDbConnection = await asyncio.wait_for(self.pool.get(),
+                        max(start_time + timeout - time.monotonic(), 0))
+                    self.pooled_conn_gauge.dec()
+                except asyncio.TimeoutError as e:
+                    deadlines.observe(self.resource_id, 'connection', time.monotonic() - start_time)
+                    msg = f'{timeout:g}-sec timeout waiting for a pooled connection'
+                    self.conn_acquire_error_counter.inc()
+                    # str(e) is empty, so don't add log_kv_pairs below
+                    raise AppTimeoutError(f'{msg} for {self.resource_id}', log_msg=msg,
+                                          log_kv_pairs=f'resource_id={self.resource_id}')
+                # if the connection is dead it is replaced and we wait for another one
+                conn_obtained = await self.validate_connection(db_conn)
+        wait_duration = round(time.monotonic() - start_time, 3)
+        self.acquire_conn_hist.observe(wait_duration)
+        deadlines.observe(self.resource_id, 'connection', wait_duration)
+        self.acquire_stats.acquires      += 1
+        self.acquire_stats.wait_duration += wait_duration
+        self.acquire_stats.peak_in_use    = max(self.acquire_stats.peak_in_use,
+                                                self.conn_count - self.pool.qsize())
         db_conn.reset_usage_duration()
+        db_conn.acquired_time_mono = time.monotonic()
         return db_conn
 
     async def release_connection(self, db_conn: BaseDbConnection):
         db_conn.increment_use()
         self.conn_usage_hist.observe(db_conn.usage_duration)
-        if db_conn.is_expired():
-            log.debug('dbconn-expired', 'connection expired', **db_conn.as_kv_pairs(),
+        hold_duration = round(time.monotonic() - db_conn.acquired_time_mono, 3)
+        self.conn_hold_hist.observe(hold_duration)
+        self.acquire_stats.releases      += 1
+        self.acquire_stats.hold_duration += hold_duration
+        if not db_conn.is_open:  # the connection was closed due to a query error or an abandoned stream
+            log.debug('dbconn-closed', 'connection was closed while in use', **db_conn.as_kv_pairs(),
                       resource_id=f'{self.resource_id}')
-            await db_conn.close()
             async with self.lock:
-                self.conn_count -= 1
-                self.closed_conn_counter.inc()
-                self.conn_gauge.dec()
+                await self.discard_connection(db_conn)
+            return
+        async with self.lock:
+            if db_conn.is_expired():
+                # a connection that was already replaced used its recycle token when the
+                # replacement was requested
+                if db_conn.replacement_requested or self.take_recycle_token():
+                    log.debug('dbconn-expired', 'connection expired', **db_conn.as_kv_pairs(),
+                              resource_id=f'{self.resource_id}')
+                    await self.discard_connection(db_conn)
+                    return
+                # too many connections have been recycled recently, so keep using this one
+                self.deferred_recycle_counter.inc()
+                self.schedule_expiry(db_conn, time.monotonic()
+                                     + config.get_int(f'{self.resource_id}__db_conn_recycle_interval'))
+            elif (db_conn.is_expiring() and not db_conn.replacement_requested
+                  and self.take_recycle_token()):
+                # open the replacement now, so the pool does not shrink when this connection closes
+                log.debug('dbconn-req', 'connection expiring soon, requesting a replacement',
+                          **db_conn.as_kv_pairs(), resource_id=f'{self.resource_id}')
+                db_conn.replacement_requested = True
+                self.pending_replacements    += 1
                 self.add_conn_queue.put_nowait(1)
-        else:
-            async with self.lock:
-                self.pool.put_nowait(db_conn)
-                self.pooled_conn_gauge.inc()
-                # since f-strings are evaluated even if the log level is not enabled,
-                # check the level first, especially since we have the lock
-                if config.get('log_level') == 'DEBUG':
-                    log.debug('dbconn-released', 'connection put back in pool', **db_conn.as_kv_pairs(),
-                              resource_id=f'{self.resource_id}', conn_count=f'{self.conn_count}')
+            db_conn.last_used_time_mono = time.monotonic()
+            self.pool.put_nowait(db_conn)
+            self.pooled_conn_gauge.inc()
+            # since f-strings are evaluated even if the log level is not enabled,
+            # check the level first, especially since we have the lock
+            if config.get('log_level') == 'DEBUG':
+                log.debug('dbconn-released', 'connection put back in pool', **db_conn.as_kv_pairs(),
+                          resource_id=f'{self.resource_id}', conn_count=f'{self.conn_count}')
+
+    async def validate_connection(self, db_conn:BaseDbConnection):
+        ''' If <resource_id>__db_conn_validate_idle_time is set (0 = off) and db_conn has been idle
+            at least that many seconds (e.g., long enough for the DB to time it out), pings it.
+            Returns False if the connection was dead, in which case it was discarded and replaced. '''
+        idle_time = config.get_int(f'{self.resource_id}__db_conn_validate_idle_time')
+        if not idle_time or time.monotonic() - db_conn.last_used_time_mono < idle_time:
+            return True
+        if await self.ping_connection(db_conn):
+            return True
+        async with self.lock:
+            await self.discard_connection(db_conn)
+        return False
+
+    async def ping_connection(self, db_conn:BaseDbConnection):
+        'pings a connection that is not in the pool; returns False, after closing it, if it is dead'
+        start_time = time.monotonic()
+        alive      = await db_conn.ping()
+        self.ping_hist.observe(time.monotonic() - start_time)
+        if not alive:
+            self.ping_failure_counter.inc()
+            log.warning('dbconn-dead', 'connection failed a liveness ping', **db_conn.as_kv_pairs(),
+                        resource_id=f'{self.resource_id}')
+        return alive
+
+    async def keepalive_connections(self):
+        ''' This background task/coroutine pings the connections that have been idle in the pool
+            for at least <resource_id>__db_conn_keepalive_interval seconds (0 = off), so the DB or
+            a firewall does not time them out, and replaces any that are dead. The connections are
+            pinged one at a time, each taken out of the pool while it is pinged (so the lock is not
+            held during the ping), so acquirers still find the other idle connections in the pool. '''
+        task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-keepalive'
+        asyncio.current_task().set_name(task_name)
+        log.info('task-running', f'task {task_name} is running')
+        while not shutdown_event.is_set():
+            interval = config.get_int(f'{self.resource_id}__db_conn_keepalive_interval')
+            await asyncio.sleep(interval or 60)  # if disabled, check again later in case the config changes
+            if not interval:
+                continue
+            # a pinged connection is no longer idle (and a dead one is discarded), so this ends
+            while not shutdown_event.is_set():
+                async with self.lock:
+                    db_conn = self.pool.remove_idle(interval)
+                    if not db_conn:
+                        break
+                    self.pooled_conn_gauge.dec()
+                is_alive = await self.ping_connection(db_conn)
+                async with self.lock:
+                    if is_alive:
+                        self.pool.put_nowait(db_conn)
+                        self.pooled_conn_gauge.inc()
+                        if db_conn.is_expired():
+                            # it may have been due while it was out of the pool
+                            self.schedule_expiry(db_conn, 0)
+                    else:
+                        await self.discard_connection(db_conn)
+
+    async def discard_connection(self, db_conn: BaseDbConnection, replace=True):
+        ''' Closes a connection that is not in the pool and, if replace is True, requests a new one,
+            unless a replacement was already requested. self.lock must be held by the caller. '''
+        if db_conn.is_open:
+            await db_conn.close()
+        self.conn_count -= 1
+        self.closed_conn_counter.inc()
+        self.conn_gauge.dec()
+        self.release_budget()
+        if db_conn.replacement_requested:
+            self.pending_replacements -= 1
+        elif replace:
+            self.add_conn_queue.put_nowait(1)
+
+    def take_recycle_token(self):
+        ''' Returns True if another expired connection may be recycled (closed and replaced) now.
+            At most <resource_id>__db_conn_max_recycles_per_interval connections are recycled per
+            db_conn_recycle_interval seconds (0 means no limit), to avoid reconnect storms. '''
+        max_recycles = config.get_int(f'{self.resource_id}__db_conn_max_recycles_per_interval')
+        if not max_recycles:
+            return True
+        now = time.monotonic()
+        if now - self.recycle_interval_start_mono >= config.get_int(f'{self.resource_id}__db_conn_recycle_interval'):
+            self.recycle_interval_start_mono = now
+            self.recycle_count               = 0
+        if self.recycle_count >= max_recycles:
+            return False
+        self.recycle_count += 1
+        return True
+
+    async def reserve_budget(self):
+        ''' Reserves a connection from the budget that is shared by all workers, if
+            <resource_id>__db_global_max_connections is set (0 = no global limit).
+            Returns False if the budget is used up. The budget file is read and written in a
+            thread, so do not hold self.lock while awaiting this. '''
+        global_max = config.get_int(f'{self.resource_id}__db_global_max_connections')
+        if not global_max:
+            return True
+        if not await asyncio.to_thread(self.budget.try_reserve, global_max):
+            return False
+        self.budget_reserved += 1
+        return True
+
+    def release_budget(self):
+        ''' Gives a connection back to the budget that is shared by all workers. The budget file
+            is updated in a thread by a separate task, so callers can hold self.lock. '''
+        if self.budget_reserved:
+            self.budget_reserved -= 1
+            task = asyncio.create_task(asyncio.to_thread(self.budget.release),
+                                       name=f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-budget-release')
+            self.budget_tasks.add(task)  # keep a reference so the task is not garbage collected
+            task.add_done_callback(self.budget_tasks.discard)
 
     async def create_connections(self):
-        'this background task/coroutine creates new connections and puts them in the pool'
+        ''' This background task/coroutine creates new connections and puts them in the pool.
+            Up to <resource_id>__db_conn_create_parallelism connections are opened concurrently,
+            each in its own task, so that a cold start or a burst does not have to wait for
+            one connection handshake after another. '''
         task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-connections'
         asyncio.current_task().set_name(task_name)
         log.info('task-running', f'task {task_name} is running')
         while not shutdown_event.is_set():
             await self.add_conn_queue.get()
+            # wait until fewer than the allowed number of connections are being opened
+            async with self.create_conn_condition:
+                await self.create_conn_condition.wait_for(lambda: self.creating_conn_count <
+                    config.get_int(f'{self.resource_id}__db_conn_create_parallelism'))
             async with self.lock:
-                if self.conn_count == config.get_int(f'{self.resource_id}__db_max_conn_pool_size'):
-                    # the max number of connections are open, so don't create any more connections
+                if (self.conn_count + self.creating_conn_count >=
+                        config.get_int(f'{self.resource_id}__db_max_conn_pool_size') + self.pending_replacements):
+                    # the max number of connections are open or being opened, so don't create
+                    # any more connections
                     continue
-            log.debug('dbconn-req', 'about to create a new DB connection', resource_id=f'{self.resource_id}')
-            db_conn:BaseDbConnection = self.conn_class(self.resource_id)
-            sleep_time = config.get_int(f'{self.resource_id}__db_conn_retry_wait_period')
+                self.creating_conn_count += 1  # held while the budget is checked, outside the lock
+            if not await self.reserve_budget():
+                async with self.lock:
+                    self.creating_conn_count -= 1
+                # the other workers have all of the connections the DB resource allows; they see that
+                # this worker wants one and close idle connections, see share_connection_budget()
+                self.budget_denial_counter.inc()
+                log.debug('dbconn-budget', 'global connection budget used up, will retry',
+                          resource_id=f'{self.resource_id}')
+                await asyncio.sleep(config.get_int(f'{self.resource_id}__db_global_budget_interval'))
+                if ((self.pool.empty() or self.conn_count < config.get_int(f'{self.resource_id}__db_min_conn_pool_size'))
+                        and not self.add_conn_queue.full()):
+                    self.add_conn_queue.put_nowait(1)  # a connection is still needed, try again
+                continue
+            # if a previous attempt failed, all attempts back off until the retry wait period is over
+            sleep_time = self.retry_after_time_mono - time.monotonic()
+            if sleep_time > 0:
+                log.debug('task-sleep', f'background task sleeping {sleep_time:.1f} secs before open conn retry',
+                          resource_id=f'{self.resource_id}')
+                await asyncio.sleep(sleep_time)
+            task = asyncio.create_task(self.create_connection(), name=f'{task_name}-open')
+            self.create_conn_tasks.add(task)  # keep a reference so the task is not garbage collected
+            task.add_done_callback(self.create_conn_tasks.discard)
+
+    async def create_connection(self):
+        ''' Opens one new connection and puts it in the pool. Only create_connections() should
+            call this, after it has incremented creating_conn_count. '''
+        log.debug('dbconn-req', 'about to create a new DB connection', resource_id=f'{self.resource_id}')
+        db_conn:BaseDbConnection = self.conn_class(self.resource_id)
+        sleep_time = config.get_int(f'{self.resource_id}__db_conn_retry_wait_period')
+        try:
             try:
                 await db_conn.open(self.conn_params)
             except AppTimeoutError as e:
@@ -157,51 +413,198 @@ class DbConnectionPool:
             except (DatabaseError, WithDetailsError) as e:
                 _conn_creation_error_counter.labels(self.resource_id, 'other').inc()
                 log.error('dbconn-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs))
+            except Exception as e:
+                # a driver error that the connection class did not wrap; without this branch,
+                # creating_conn_count and the budget would never be given back
+                _conn_creation_error_counter.labels(self.resource_id, 'other').inc()
+                log.error('dbconn-err', f'unexpected error opening a connection: {e!r}',
+                          resource_id=f'{self.resource_id}')
+                if db_conn.is_open:
+                    try:
+                        await db_conn.close()
+                    except Exception:
+                        pass  # the connection is likely already broken
+                    db_conn.is_open = False
             if db_conn.is_open:
                 self.last_conn_created_time_gauge.set_to_current_time()
                 self.created_conn_counter.inc()
                 self.conn_gauge.inc()
                 async with self.lock:
-                    self.conn_count += 1
+                    self.conn_count          += 1
+                    self.creating_conn_count -= 1
                     await self.pool.put(db_conn)
                     self.pooled_conn_gauge.inc()
+                    self.schedule_expiry(db_conn)
                 log.debug('dbconn-added', 'new connection put into pool by background task',
                           conn_id=f'{db_conn.conn_id}', resource_id=f'{self.resource_id}')
                 self.consecutive_create_conn_errors = 0
             else:
+                async with self.lock:
+                    self.creating_conn_count -= 1
+                    self.release_budget()
                 self.last_conn_created_error_time_gauge.set_to_current_time()
-                self.add_conn_queue.put_nowait(1)  # try again
                 self.consecutive_create_conn_errors += 1
                 if self.consecutive_create_conn_errors and self.consecutive_create_conn_errors % 5 == 0:
                     log.error('dbconn-err', f'background task failed {self.consecutive_create_conn_errors} '
                               f'consecutive times to open a new connection', resource_id=f'{self.resource_id}')
-                # sleep to avoid possibly trying to create a connection in a tight loop
-                log.debug('task-sleep', f'background task sleeping {sleep_time} secs before open conn retry',
+                # back off to avoid possibly trying to create connections in a tight loop
+                self.retry_after_time_mono = max(self.retry_after_time_mono, time.monotonic() + sleep_time)
+                self.add_conn_queue.put_nowait(1)  # try again
+        finally:
+            async with self.create_conn_condition:
+                self.create_conn_condition.notify()
+
+    async def share_connection_budget(self):
+        ''' This background task/coroutine lets idle connections move to the workers that need them
+            when <resource_id>__db_global_max_connections is set. Every db_global_budget_interval
+            seconds, if another worker was recently denied a connection, one idle connection is
+            closed, as long as more than db_min_conn_pool_size connections are open. '''
+        task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-budget'
+        asyncio.current_task().set_name(task_name)
+        log.info('task-running', f'task {task_name} is running')
+        while not shutdown_event.is_set():
+            interval = config.get_int(f'{self.resource_id}__db_global_budget_interval')
+            await asyncio.sleep(interval)
+            if (not self.budget_reserved or self.pool.empty() or self.conn_count - self.pending_replacements
+                    <= config.get_int(f'{self.resource_id}__db_min_conn_pool_size')):
+                continue
+            if not await asyncio.to_thread(self.budget.wanted_by_others, time.time() - 2 * interval):
+                continue
+            async with self.lock:
+                if self.pool.empty():
+                    continue
+                db_conn:BaseDbConnection = self.pool.get_nowait()
+                log.debug('dbconn-shed', 'closing idle connection for another worker', **db_conn.as_kv_pairs(),
                           resource_id=f'{self.resource_id}')
-                await asyncio.sleep(sleep_time)
+                self.pooled_conn_gauge.dec()
+                self.budget_shed_counter.inc()
+                await self.discard_connection(db_conn, replace=False)
 
-    async def check_connections(self):
-        'removes any expired connections from the pool'
-        log.debug('dbconn-check', 'checking connections', resource_id=f'{self.resource_id}')
-        not_expired_conns = []
-        async with self.lock: 
-            while not self.pool.empty():
-                db_conn:BaseDbConnection = await self.pool.get()
-                if db_conn.is_expired():
-                    log.debug('dbconn-expired', 'connection expired', **db_conn.as_kv_pairs(),
-                               resource_id=f'{self.resource_id}')
-                    await db_conn.close()
-                    self.conn_count -= 1
-                    self.closed_conn_counter.inc()
-                else:
-                    not_expired_conns.append(db_conn)
-            for conn in not_expired_conns:
-                await self.pool.put(conn)
-                log.debug('dbconn-keep', f'connection kept in pool', **db_conn.as_kv_pairs(),
-                           resource_id=f'{self.resource_id}')
-            for _ in range(config.get_int(f'{self.resource_id}__db_min_conn_pool_size') - self.conn_count
-                           - self.add_conn_queue.qsize()):
-                log.debug('deconn-req', 'requesting a new conn be put into pool', resource_id=f'{self.resource_id}')
+    async def autoscale(self):
+        ''' This background task/coroutine resizes the pool when <resource_id>__db_pool_autoscale
+            is enabled. Every db_pool_autoscale_interval seconds, the number of connections needed
+            is estimated from the connection acquire rate, how long connections are held
+            (Little's law), the peak number of connections in use and the acquire wait times.
+            The pool grows right away, ahead of demand if the acquire rate is rising, but it only
+            shrinks, by closing idle connections, after demand has been lower for
+            db_pool_autoscale_shrink_intervals consecutive intervals. '''
+        task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-autoscale'
+        asyncio.current_task().set_name(task_name)
+        log.info('task-running', f'task {task_name} is running')
+        prev_acquire_rate = 0
+        low_demand_intervals = 0
+        while not shutdown_event.is_set():
+            interval = config.get_int(f'{self.resource_id}__db_pool_autoscale_interval')
+            await asyncio.sleep(interval)
+            stats = self.acquire_stats
+            self.acquire_stats = PoolIntervalStats(self.conn_count - self.pool.qsize())
+            if not config.getbool(f'{self.resource_id}__db_pool_autoscale'):
+                continue
+            min_size     = config.get_int(  f'{self.resource_id}__db_min_conn_pool_size')
+            max_size     = config.get_int(  f'{self.resource_id}__db_max_conn_pool_size')
+            headroom     = config.get_float(f'{self.resource_id}__db_pool_autoscale_headroom')
+            acquire_rate = stats.acquires / interval
+            demand       = stats.peak_in_use
+            if stats.releases:
+                demand = max(demand, acquire_rate * stats.hold_duration / stats.releases)
+            if acquire_rate > prev_acquire_rate > 0:
+                # demand is ramping up, so project it forward one interval (at most doubling it)
+                demand *= min(acquire_rate / prev_acquire_rate, 2)
+            if (stats.acquires and stats.wait_duration / stats.acquires >
+                    config.get_float(f'{self.resource_id}__db_pool_autoscale_wait_threshold')):
+                demand = max(demand, self.conn_count + 1)  # requests are waiting for connections
+            prev_acquire_rate = acquire_rate
+            target_size = min(max(math.ceil(demand * (1 + headroom)), min_size), max_size)
+            if target_size >= self.target_size:
+                low_demand_intervals = 0
+                self.target_size = target_size
+            else:
+                low_demand_intervals += 1
+                if low_demand_intervals >= config.get_int(
+                        f'{self.resource_id}__db_pool_autoscale_shrink_intervals'):
+                    low_demand_intervals = 0
+                    self.target_size = target_size
+            self.target_size_gauge.set(self.target_size)
+            await self.resize(self.target_size)
+
+    async def resize(self, target_size:int):
+        'requests new connections or closes idle connections until there are target_size connections'
+        async with self.lock:
+            # connections that are about to be closed because they were replaced are not counted
+            conn_count    = self.conn_count - self.pending_replacements
+            pending_count = conn_count + self.creating_conn_count + self.add_conn_queue.qsize()
+            for _ in range(target_size - pending_count):
+                log.debug('dbconn-req', 'autoscale requesting a new conn be put into pool',
+                          resource_id=f'{self.resource_id}', target_size=target_size)
                 self.add_conn_queue.put_nowait(1)
-            self.pooled_conn_gauge.set(self.pool.qsize())
-            self.conn_gauge.set(self.conn_count)
+            while conn_count > target_size and not self.pool.empty():
+                db_conn:BaseDbConnection = self.pool.get_nowait()
+                log.debug('dbconn-shrink', 'autoscale closing idle connection', **db_conn.as_kv_pairs(),
+                          resource_id=f'{self.resource_id}', target_size=target_size)
+                self.pooled_conn_gauge.dec()
+                await self.discard_connection(db_conn, replace=False)
+                # recomputed, since closing a connection whose replacement was already requested
+                # does not change the count
+                conn_count = self.conn_count - self.pending_replacements
+
+    def schedule_expiry(self, db_conn:BaseDbConnection, expiry_time_mono=None):
+        ''' Adds db_conn to the expiry heap, to be expired at expiry_time_mono (default: when it
+            reaches its max age). self.lock must be held by the caller. '''
+        if expiry_time_mono is None:
+            expiry_time_mono = db_conn.expiry_time_mono()
+        if len(self.expiry_heap) > 2 * self.conn_count + 10:
+            # entries for closed connections are normally skipped when they are popped, but drop
+            # them now so the heap does not grow if connections are closed well before their max age
+            self.expiry_heap = [entry for entry in self.expiry_heap if entry[2].is_open]
+            heapq.heapify(self.expiry_heap)
+        heapq.heappush(self.expiry_heap, (expiry_time_mono, next(self.expiry_seq), db_conn))
+        if self.expiry_heap[0][2] is db_conn:
+            self.expiry_heap_changed.set()  # wake up expire_connections(), it has an earlier deadline
+
+    async def expire_connections(self):
+        ''' This background task/coroutine closes idle connections when they reach their max age.
+            The expiry time of each connection is kept in a heap, so the task sleeps until the
+            next connection is due and then only looks at the connections that are due, rather
+            than periodically draining and refilling the whole pool under the lock.
+            A connection that is in use when it is due is expired by release_connection(). '''
+        task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-expiry'
+        asyncio.current_task().set_name(task_name)
+        log.info('task-running', f'task {task_name} is running')
+        while not shutdown_event.is_set():
+            sleep_time = self.expiry_heap[0][0] - time.monotonic() if self.expiry_heap else None
+            if sleep_time is None or sleep_time > 0:
+                try:
+                    await asyncio.wait_for(self.expiry_heap_changed.wait(), sleep_time)
+                except asyncio.TimeoutError:
+                    pass
+                self.expiry_heap_changed.clear()
+                continue
+            now = time.monotonic()
+            async with self.lock:
+                while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                    _, _, db_conn = heapq.heappop(self.expiry_heap)
+                    if not db_conn.is_open:  # already closed and removed from the pool
+                        continue
+                    if not db_conn.is_expired():
+                        # db_conn_max_age was increased since the connection was scheduled
+                        self.schedule_expiry(db_conn)
+                        continue
+                    if not self.pool.remove(db_conn):
+                        continue  # the connection is in use
+                    self.pooled_conn_gauge.dec()
+                    if db_conn.replacement_requested or self.take_recycle_token():
+                        log.debug('dbconn-expired', 'connection expired', **db_conn.as_kv_pairs(),
+                                  resource_id=f'{self.resource_id}')
+                        await self.discard_connection(db_conn, replace=False)
+                    else:
+                        self.deferred_recycle_counter.inc()
+                        self.pool.put_nowait(db_conn)
+                        self.pooled_conn_gauge.inc()
+                        self.schedule_expiry(db_conn, now
+                                             + config.get_int(f'{self.resource_id}__db_conn_recycle_interval'))
+                # restore the min pool size
+                for _ in range(config.get_int(f'{self.resource_id}__db_min_conn_pool_size')
+                               - (self.conn_count - self.pending_replacements)
+                               - self.creating_conn_count - self.add_conn_queue.qsize()):
+                    log.debug('dbconn-req', 'requesting a new conn be put into pool', resource_id=f'{self.resource_id}')
+                    self.add_conn_queue.put_nowait(1)
@@ -0,0 +1,92 @@
+''' Request deadlines. app_middleware sets each request's deadline (in deadline_var, as a
+    time.monotonic() time) from the request_deadline_header header--the secs the caller is willing
+    to wait, e.g., set by a proxy to its own timeout--or else from the route's default in
+    request_deadlines. A header can only shorten the route's deadline.
+    Acquiring a request slot, acquiring a DB connection and running a query each wait at most the
+    remaining time, so work stops when the caller has given up. Each step also rejects a request
+    right away if the remaining time is less than the recent latency of that step plus the later
+    steps, since it would most likely not finish in time anyway; a doomed request then stops
+    consuming a slot or a connection that other requests could use. The latencies are EWMAs per
+    resource_id, and for the query step also per route, since routes run different queries.
+    Timeouts are recorded too, and an estimate decays while it is not updated, so an estimate that
+    is higher than the deadlines--which would otherwise reject every request, so it would never be
+    updated again--lets requests through again after a while. '''
+import time
+from   prometheus_client import Counter
+from   .exceptions import AppTimeoutError
+from   .shared     import deadline_var, route_var
+from   .           import config
+
+STAGES              = ('slot', 'connection', 'query')  # in the order a request goes through them
+_EWMA_ALPHA         = 0.2
+_ESTIMATE_HALF_LIFE = 30     # secs; an estimate that is not updated halves this often
+_MIN_TIMEOUT        = 0.001  # secs; 0 would mean the driver's default timeout
+# (resource_id, stage, route or None) -> (EWMA of the stage's latency (secs), time.monotonic() of the
+# last update)
+_estimates: dict[tuple, tuple] = {}
+_deadline_rejections_counter = Counter('wt_deadline_rejections_total',
+    'requests rejected because their deadline would pass before they could finish',
+    ['resource_id', 'stage'])
+
+def _route_values(key:str):
+    values = {}
+    for route_value in config.get(key).split():
+        route, _, value = route_value.rpartition(':')
+        values[route] = float(value)
+    return values
+
+def request_deadline(path:str, headers):
+    'returns the deadline of a request (a time.monotonic() time), or None if it has no deadline'
+    secs = _route_values('request_deadlines').get(path, config.get_float('request_deadline_default'))
+    if (header := config.get('request_deadline_header')) and (value := headers.get(header)):
+        try:
+            header_secs = float(value)
+        except ValueError:
+            header_secs = 0
+        if header_secs > 0:
+            secs = min(secs, header_secs) if secs > 0 else header_secs
+    return time.monotonic() + secs if secs > 0 else None
+
+def remaining():
+    'secs until the current request deadline (<= 0 if it has passed), or None if there is none'
+    deadline = deadline_var.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def bounded_timeout(timeout:float):
+    ''' returns timeout, shortened to the time remaining until the deadline, but at least
+        _MIN_TIMEOUT, since the drivers treat a 0 timeout as no timeout (their default) '''
+    left = remaining()
+    return timeout if left is None else round(max(min(timeout, left), _MIN_TIMEOUT), 3)
+
+def _key(resource_id:str, stage:str):
+    # slots and connections are shared by all of the routes of a resource_id, queries are not
+    return (resource_id, stage, route_var.get() if stage == 'query' else None)
+
+def _estimate(key:tuple, now:float):
+    estimate, update_time = _estimates.get(key, (0, now))
+    return estimate * 0.5 ** ((now - update_time) / _ESTIMATE_HALF_LIFE)
+
+def observe(resource_id:str, stage:str, duration:float):
+    ''' records the latency of a stage, for admit(); for a timeout, duration is the time waited,
+        which is a lower bound of the latency '''
+    key, now = _key(resource_id, stage), time.monotonic()
+    estimate = _estimate(key, now) if key in _estimates else duration
+    _estimates[key] = (estimate + _EWMA_ALPHA * (duration - estimate), now)
+
+def admit(resource_id:str, stage:str):
+    ''' raises an AppTimeoutError if the request has a deadline and the time remaining is less than
+        the estimated latency of stage and the stages after it '''
+    left = remaining()
+    if left is None:
+        return
+    now    = time.monotonic()
+    needed = sum(_estimate(_key(resource_id, later_stage), now) for later_stage in STAGES[STAGES.index(stage):])
+    if left <= 0 or (config.getbool('request_deadline_admission') and left < needed):
+        _deadline_rejections_counter.labels(resource_id, stage).inc()
+        msg = f'request deadline is {max(left, 0):.3f} secs away, not enough time for the {stage} and later stages'
+        raise AppTimeoutError(f'{msg} for resource {resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={resource_id} stage={stage} estimated_secs={needed:.3f}')
+
+def init_metric_children(resource_id:str):
+    for stage in STAGES:
+        _deadline_rejections_counter.labels(resource_id, stage)
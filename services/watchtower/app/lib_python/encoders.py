@@ -0,0 +1,238 @@
+''' Encoders that convert fetched rows into bytes that can be sent directly to the client.
+    These are used by the streaming routes, which encode each batch of rows as it is fetched
+    rather than building the entire response in memory first. '''
+import csv, datetime, decimal, io, itertools, re
+import numpy  as np
+import orjson  # https://github.com/ijl/orjson
+try:
+    import pyarrow         as pa  # optional, only needed for the arrow and parquet formats
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# errors that encoding a batch of rows can raise, e.g., when a value does not fit the Arrow schema
+# (pyarrow's ArrowInvalid and ArrowTypeError are also ValueError and TypeError subclasses)
+ENCODE_ERRORS = (ValueError, TypeError) + ((pa.ArrowException,) if pa else ())
+DELIMITERS  = {'pipe': '|', 'comma': ',', 'tab': '\t'}
+MEDIA_TYPES = {
+    'psv':     'text/csv',
+    'arrow':   'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def negotiate_format(accept:str, format:str=None):
+    ''' returns the streamed results format: format (a query parameter) if given, otherwise arrow
+        or parquet if the Accept header asks for it, otherwise psv '''
+    if not format:
+        format = next((fmt for fmt, media_type in MEDIA_TYPES.items()
+                       if media_type in (accept or '') and fmt != 'psv'), 'psv')
+    if format != 'psv' and pa is None:
+        raise ValueError(f'the {format} format is not available, pyarrow is not installed')
+    return format
+
+class PsvEncoder:
+    ''' Encodes batches of rows as delimiter-separated values (PSV by default), one row per line,
+        and returns the results as bytes chunks of at least chunk_size bytes (except the last one),
+        so that a streaming response makes one ASGI send call per chunk rather than per row.
+        quoting:
+        - none    - values are written as is, with str(); values that contain the delimiter or a
+                    newline are not escaped
+        - minimal - values that contain the delimiter, a quote or a newline are quoted (as in CSV);
+                    None is written as an empty value '''
+    def __init__(self, chunk_size=65536, delimiter='|', header=False, quoting='none'):
+        self.chunk_size   = chunk_size
+        self.delimiter    = delimiter
+        self.quoting      = quoting
+        self.write_header = header
+        self.buffer       = io.StringIO()
+        if quoting == 'minimal':
+            self.writer = csv.writer(self.buffer, delimiter=delimiter, lineterminator='\n')
+        elif quoting != 'none':
+            raise ValueError(f'unsupported {quoting=!s}')
+
+    def encode(self, rows, columns) -> list[bytes]:
+        'adds a batch of rows and returns the chunks that are full, if any'
+        if self.write_header:
+            self.write_header = False
+            self._write([columns])
+        self._write(rows)
+        if self.buffer.tell() < self.chunk_size:
+            return []
+        return [self.flush()]
+
+    def flush(self) -> bytes:
+        'returns whatever has not been returned yet'
+        chunk = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return chunk
+
+    def _write(self, rows):
+        if self.quoting == 'minimal':
+            self.writer.writerows(rows)
+        else:
+            delimiter = self.delimiter
+            self.buffer.write(''.join([delimiter.join(map(str, row)) + '\n' for row in rows]))
+
+class _ChunkSink:
+    'a write-only file-like object that collects what pyarrow writes to it, so it can be streamed'
+    closed = False
+    def __init__(self):
+        self.chunks = []
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    def flush(self):
+        pass
+    def close(self):
+        pass
+    def take(self) -> bytes:
+        chunk = b''.join(self.chunks)
+        self.chunks.clear()
+        return chunk
+
+class ArrowEncoder:
+    ''' Encodes batches of rows as an Arrow IPC stream, one record batch per fetched batch, or as a
+        Parquet file, one row group per row_group_size rows. It has the same interface as PsvEncoder.
+        The schema comes from dtypes (column name -> NumPy dtype hints, see DataFrameBuilder) and is
+        otherwise inferred from the rows. The schema cannot change once the stream has started, so
+        while a column without a hint has only had NULLs, batches are held back (up to
+        row_group_size rows) until a value shows its type; a column that is still all NULL then
+        becomes a string column, and its later values are converted with str(). '''
+    def __init__(self, format='arrow', dtypes:dict=None, row_group_size=65536):
+        self.format         = format
+        self.dtypes         = dtypes or {}
+        self.row_group_size = row_group_size
+        self.sink           = _ChunkSink()
+        self.writer         = None
+        self.types          = None  # the Arrow type of each column, None while it is unknown (all NULL)
+        self.held_rows      = []    # rows held back until the type of each column is known
+        self.str_columns    = set() # indexes of the columns that were all NULL when the stream started
+        self.pending        = []    # parquet record batches that are not written yet
+        self.pending_rows   = 0
+
+    def encode(self, rows, columns) -> list[bytes]:
+        if self.writer is None:
+            self._infer_types(rows, columns)
+            if rows and None in self.types and len(self.held_rows) + len(rows) < self.row_group_size:
+                self.held_rows.extend(rows)
+                return []
+            rows, self.held_rows = self.held_rows + list(rows), []
+            self._start(columns)
+        arrays = [self._array(values, i, field) for i, (values, field) in
+                  enumerate(zip(zip(*rows), self.schema))] if rows else [pa.array([], field.type) for field in self.schema]
+        batch  = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.format == 'arrow':
+            self.writer.write_batch(batch)
+        elif rows:
+            self.pending.append(batch)
+            self.pending_rows += len(rows)
+            if self.pending_rows >= self.row_group_size:
+                self._write_row_group()
+        chunk = self.sink.take()
+        return [chunk] if chunk else []
+
+    def flush(self) -> bytes:
+        'ends the stream/file; returns the remaining bytes'
+        held_chunks = []
+        if self.held_rows:  # the stream ended while a column was still all NULL
+            rows, self.held_rows = self.held_rows, []
+            self._start(self.columns)
+            held_chunks = self.encode(rows, self.columns)
+        if self.writer is None:
+            return b''
+        if self.pending:
+            self._write_row_group()
+        self.writer.close()
+        self.writer = None
+        return b''.join(held_chunks) + self.sink.take()
+
+    def _write_row_group(self):
+        self.writer.write_table(pa.Table.from_batches(self.pending, schema=self.schema))
+        self.pending      = []
+        self.pending_rows = 0
+
+    def _infer_types(self, rows, columns):
+        'sets the types of the columns that are still unknown, from dtypes or from the values in rows'
+        if self.types is None:
+            self.columns = columns
+            self.types   = [None] * len(columns)
+            for i, column in enumerate(columns):
+                if column in self.dtypes:
+                    dtype = np.dtype(self.dtypes[column])
+                    self.types[i] = (pa.timestamp(np.datetime_data(dtype)[0]) if dtype.kind == 'M' else
+                                     pa.from_numpy_dtype(dtype))
+        for i, type_ in enumerate(self.types):
+            if type_ is None and rows:
+                type_ = pa.array([row[i] for row in rows]).type
+                self.types[i] = None if pa.types.is_null(type_) else type_
+
+    def _start(self, columns):
+        self.str_columns = {i for i, type_ in enumerate(self.types) if type_ is None}
+        self.schema = pa.schema([pa.field(column, type_ or pa.string())
+                                 for column, type_ in zip(columns, self.types)])
+        self.writer = (pa.ipc.new_stream(self.sink, self.schema) if self.format == 'arrow' else
+                       pq.ParquetWriter(self.sink, self.schema))
+
+    def _array(self, values, i, field):
+        if i in self.str_columns:
+            values = [None if value is None else str(value) for value in values]
+        return pa.array(values, type=field.type)
+
+def _json_default(obj):
+    ''' converts the values that orjson does not serialize itself (or is told to pass through);
+        Decimals become floats, so they lose precision beyond about 15 significant digits '''
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+def json_dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+_NUMBER_TYPES = {int, float, bool, type(None)}
+_JSON_VALUE   = re.compile(rb'"[^"]*"|[^,]+')  # one value of a JSON array that has no escapes
+
+def _encode_column(values) -> tuple[list, bool]:
+    ''' Returns the JSON encoding of each value of a column, and True if all of the values are
+        strings whose quotes were left off. The whole column is encoded with one orjson call and
+        then split into values, which is safe since numbers, null, true and false cannot contain a
+        comma and a string can only contain a quote if the encoding has a backslash. '''
+    types = set(map(type, values))
+    if decimal.Decimal in types:
+        values = [float(value) if type(value) is decimal.Decimal else value for value in values]
+        types  = set(map(type, values))
+    if types <= _NUMBER_TYPES:
+        return json_dumps(values)[1:-1].split(b','), False
+    if types == {datetime.datetime} and all(value.tzinfo is None for value in values):
+        # orjson's own datetime encoding, in the format that _json_default() returns
+        encoded = orjson.dumps(values, option=orjson.OPT_OMIT_MICROSECONDS).replace(b'T', b' ')
+    else:
+        encoded = json_dumps(values)
+    if b'\\' in encoded:
+        return [json_dumps(value) for value in values], False
+    if types == {str} or types == {datetime.datetime}:
+        return encoded[2:-2].split(b'","'), True
+    return _JSON_VALUE.findall(encoded, 1, len(encoded) - 1), False
+
+def json_encode_rows(rows, columns=None) -> bytes:
+    ''' Encodes a batch of rows as comma-separated JSON values, without the enclosing brackets, so the
+        batches can be joined; if columns is given each row is an object, otherwise each row is an array.
+        Objects are not built as dicts: each column is encoded separately (see _encode_column()) and
+        the values are joined with precomputed '{"column":' and ',"column":' prefixes. '''
+    if not rows:
+        return b''
+    if not columns:
+        return json_dumps(rows)[1:-1]
+    parts = []
+    quote = b''  # the closing quote of the previous column, if its values were left unquoted
+    for i, (column, values) in enumerate(zip(columns, zip(*rows))):
+        encoded, unquoted = _encode_column(values)
+        prefix = quote + (b',' if i else b'{') + json_dumps(column) + b':'
+        quote  = b'"' if unquoted else b''
+        parts += (itertools.repeat(prefix + quote), encoded)
+    parts.append(itertools.repeat(quote + b'},'))
+    return b''.join(itertools.chain.from_iterable(zip(*parts)))[:-1]
@@ -6,6 +6,7 @@ from   datetime   import datetime, timedelta
 from   fastapi    import FastAPI
 from   .logging   import log
 from   .resource_manager import resource_manager
+from   .query  import prewarm_queries
 from   .shared import BACKGROUND_TASK_NAME_PREFIX, shutdown_event, sigusr1_received
 from   .       import config
 
@@ -64,14 +65,15 @@ async def background_coroutine():
             io_write_counter  .inc(info['io_counters'].write_chars - prev_io_write_chars)
             prev_io_read_chars  = info['io_counters'].read_chars
             prev_io_write_chars = info['io_counters'].write_chars
-            current_min = datetime.now().minute
-            if (current_min % 5) == 0:  # check for expired DB connections every 5 minutes
-                await resource_manager.check_db_connections()
             if sigusr1_received.is_set():  # set by handle_sigusr1() in config.py
                 log.info('sig-received', f'SIGUSR1 received up to {SLEEP_TIME} secs ago, applying any config overrides now')
                 config.apply_overrides()
                 sigusr1_received.clear()
                 log.setLevel()  # in case the log level changed
+            try:
+                await prewarm_queries()  # refreshes, in background tasks, prewarm queries that are not cached or stale
+            except Exception as e:
+                log.error('prewarm-err', f'unable to prewarm queries: {e}', exc_info=True)
             log.info('metrics2', 'metrics test', dtime=f'{(datetime.now() - timedelta(seconds=2)).replace(microsecond=0).isoformat()}', cpu=random.randint(2, 100))
             await asyncio.sleep(SLEEP_TIME)
     except Exception as e:
@@ -83,7 +85,7 @@ async def background_coroutine():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     asyncio.create_task(background_coroutine())
-    resource_manager.create_db_connection_pool_background_tasks()
+    resource_manager.create_resource_background_tasks()
     yield
     # the following code will not run until the app starts shutting down
     await shutdown()
@@ -1,11 +1,16 @@
-import time
+import math, time
 from   uuid        import uuid4
 from   fastapi.responses import JSONResponse, StreamingResponse
 from   fastapi     import Request, Response
 from   .logging    import log
-from   .shared     import cid_var, acquire_durations_var
+from   .shared     import cid_var, acquire_durations_var, deadline_var, request_class_var, route_var
 from   .shared     import request_counter, request_duration_hist, request_duration_summary
+from   .shared     import response_send_duration_hist
 from   .query      import Query
+from   .compression import compress_response
+from   .request_limiter import request_class
+from   .deadlines  import request_deadline
+from   .rate_limiter import rate_limiter
 from   .           import config
 
 def log_acquisition_durations(cid:str):
@@ -45,23 +50,41 @@ def log_query_info(request: Request, cid:str):
             kv_pairs[f'{prefix}_query'] = query.query
         kv_pairs[f'conn_id'] = query.conn_id
         kv_pairs['duration'] = query.duration
+        if query.cached:
+            kv_pairs[f'{prefix}_cached'] = True
+        if query.coalesced:
+            kv_pairs[f'{prefix}_coalesced'] = True
         if streamed_results:
             kv_pairs[f'{prefix}_row_count'] = '<streamed>'
         else:
-            if query.results is None:  kv_pairs[f'{prefix}_row_count'] = '<no rows>'
-            else:                      kv_pairs[f'{prefix}_row_count'] = f'{len(query.results)}'
+            if query.results is None:        kv_pairs[f'{prefix}_row_count'] = '<no rows>'
+            elif query.row_count is not None: kv_pairs[f'{prefix}_row_count'] = f'{query.row_count}'
+            else:                            kv_pairs[f'{prefix}_row_count'] = f'{len(query.results)}'
         if log_type == 'stats_with_results' or log_type == 'all':
             if streamed_results:  kv_pairs[f'{prefix}_results'] = '<streamed>'
             else:                 kv_pairs[f'{prefix}_results'] = query.results
     kv_pairs['cid'] = cid_var.get()
     log.info('query-stats', f'{request.method} {request.url.path} query stats', **kv_pairs)
 
+async def timed_body_iterator(body_iterator, endpoint:str):
+    'wraps a response body iterator to record how long it takes to send the body to the client'
+    start_time = time.monotonic()
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        response_send_duration_hist.labels(endpoint).observe(time.monotonic() - start_time)
+
 # -- middleware function for "global" request handling
 async def app_middleware(request: Request, call_next):
     ''' Creates a correlation ID for the request for logging and tracking purposes
         and puts that in a context variable.
         For routes that are not metrics or FastAPI docs:
+        - rejects the request (429) if the client or its API key is over its rate limit, before
+          any dependencies (e.g., request slots) are resolved
         - logs the intial request and then later a summary of the request results/response
+        - sets the request class, which RequestLimiter queues the request by, and the request
+          deadline, see deadlines.py
         - adds the correlation ID and request duration to the response headers
     '''
     cid_len = config.get_int('cid_len')
@@ -73,10 +96,25 @@ async def app_middleware(request: Request, call_next):
     # https://www.starlette.io/requests/#other-state
     start_time = time.monotonic()
     request_counter.labels(request.url.path).inc()
-    log.info('request', f'{request.method} {request.url.path}', client=f'{request.client.host}', cid=f'{cid}')
     request.state.queries = []  # Query objects are appended in Query's constructor
+    if retry_after := rate_limiter.check(request.client.host, request.headers):
+        # debug, since a client that ignores 429s would otherwise flood the logs
+        log.debug('rate-limited', f'{request.method} {request.url.path} rate limited',
+                  client=f'{request.client.host}', cid=f'{cid}')
+    else:
+        req_class = request_class(path, request.headers)
+        request_class_var.set(req_class)
+        deadline_var.set(request_deadline(path, request.headers))
+        route_var.set(path)
+        log.info('request', f'{request.method} {request.url.path}', client=f'{request.client.host}',
+                 request_class=req_class, cid=f'{cid}')
     try:
-        response:Response = await call_next(request)
+        if retry_after:
+            # the route is not called, so no dependencies (e.g., request slots) are resolved
+            response = JSONResponse(content={'detail': 'too many requests, slow down', 'cid': cid},
+                                    status_code=429, headers={'Retry-After': str(math.ceil(retry_after))})
+        else:
+            response:Response = await call_next(request)
         #raise Exception('test exception')  # DEBUG, uncomment to test error handling and grafana display
                                             #        of tracebacks with newlines
     #except HTTPException as e:
@@ -103,6 +141,9 @@ async def app_middleware(request: Request, call_next):
         request_duration_summary.labels(request.url.path, 
             # convert status code to 2xx, 4xx, 5xx for Prometheus
             str(response.status_code)[0]+'xx').observe(request_duration)
+        if hasattr(response, 'body_iterator'):
+            await compress_response(request, response)
+            response.body_iterator = timed_body_iterator(response.body_iterator, request.url.path)
         log.info('request-stats', f'{request.method} {request.url.path} results',
                  client=f'{request.client.host}',
                  queries=f'{query_count}',
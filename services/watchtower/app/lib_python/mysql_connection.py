@@ -1,12 +1,18 @@
-import asyncio, time
+import asyncio, math, time
 import aiomysql  # https://aiomysql.readthedocs.io/
 from   .exceptions         import format_exc, AppTimeoutError, DatabaseError, WithDetailsError
 from   .base_db_connection import BaseDbConnection
 from   . import config
 
 class MysqlConnection(BaseDbConnection):
+    def __init__(self, resource_id: str):
+        super().__init__(resource_id)
+        self.conn_params    = None  # kept to open a second connection to run KILL QUERY
+        self.server_timeout = None  # the session's statement timeout (secs); None = server default
+
     async def open(self, conn_params: dict, timeout=None):
         timeout = timeout or config.get_int(f'{self.resource_id}__db_conn_timeout')
+        self.conn_params = conn_params
         try:
             self.conn = await aiomysql.connect(
                 host            = conn_params['host'],
@@ -40,6 +46,70 @@ class MysqlConnection(BaseDbConnection):
         self.conn.close()
         self.is_open = False
 
+    async def _ping(self):
+        await self.conn.ping(reconnect=False)  # a COM_PING, no query is parsed
+
+    @staticmethod
+    def _server_timeout_bucket(timeout):
+        ''' rounds timeout (secs) up to a power of 2, at least 1 sec. Request deadlines make the
+            timeout differ on nearly every query, so the exact value would cost a SET round trip
+            almost every time. The client-side timeout (and KILL QUERY) still enforces the exact
+            timeout; the server timeout is the backstop for when the client is gone. '''
+        return 2 ** max(math.ceil(math.log2(timeout)), 0)
+
+    async def _set_server_timeout(self, timeout):
+        ''' Sets the session's statement timeout, so the server aborts a SELECT that runs longer than
+            timeout secs, rounded up, see _server_timeout_bucket(): max_execution_time (ms) on MySQL,
+            max_statement_time (secs) on MariaDB. This costs a round trip only when the bucket changes. '''
+        server_timeout = self._server_timeout_bucket(timeout) if self.server_side_timeouts() else 0  # 0 = no timeout
+        if server_timeout == self.server_timeout or (self.server_timeout is None and not server_timeout):
+            return
+        async with self.conn.cursor() as cursor:
+            if 'MariaDB' in self.conn.get_server_info():
+                await cursor.execute(f'SET SESSION max_statement_time = {float(server_timeout)}')
+            else:
+                await cursor.execute(f'SET SESSION max_execution_time = {int(server_timeout * 1000)}')
+        self.server_timeout = server_timeout
+
+    async def _kill_query(self):
+        ''' Aborts the running query from a second connection, since the client-side timeout only
+            abandons it. Returns True if KILL QUERY succeeded. The connection itself must be closed
+            afterwards, since its protocol state is unknown. The second connection is not counted
+            against the global connection budget: it lives for one statement, and waiting for the
+            budget (or being denied) would leave the query running, holding a connection that is
+            counted. '''
+        params  = self.conn_params
+        timeout = config.get_int(f'{self.resource_id}__db_conn_timeout')
+        try:
+            killer = await aiomysql.connect(host=params['host'], port=params['port'], user=params['user'],
+                password=params['password'], db=params['database'], autocommit=True, connect_timeout=timeout)
+            try:
+                async with killer.cursor() as cursor:
+                    await asyncio.wait_for(cursor.execute(f'KILL QUERY {self.conn.thread_id()}'), timeout)
+            finally:
+                killer.close()
+        except Exception:
+            return False
+        self.server_aborts_counter.inc()
+        return True
+
+    # max_execution_time exceeded (MySQL), max_statement_time exceeded (MariaDB)
+    _server_timeout_errors = (3024, 1969)
+    def _server_abort_error(self, timeout, e):
+        self.server_aborts_counter.inc()
+        msg = f'{timeout}-sec timeout, DB query aborted by the server'
+        return AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={self.resource_id} server_side_abort=true {format_exc(e)}')
+
+    async def _client_timeout_error(self, timeout, e):
+        'kills the query that the client gave up on and closes the connection'
+        killed = await self._kill_query()
+        await self.close()
+        msg = f'{timeout}-sec timeout waiting for DB query or fetch'
+        return AppTimeoutError(f'{msg} from resource {self.resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={self.resource_id} server_side_abort={str(killed).lower()} '
+                         f'{format_exc(e)}')
+
     _keep_connection_open_errors = ('SQL syntax', 'Unknown column')
     async def execute_query(self, query:str, results_as='psv', header=False, timeout=None):
         ''' results_as  value     return type
@@ -47,12 +117,14 @@ class MysqlConnection(BaseDbConnection):
                         json      list[dict]
                         psv       StringIO buffer '''
         timeout    = timeout or config.get_int(f'{self.resource_id}__db_default_query_timeout')
+        client_timeout = self.client_timeout(timeout)
         cursor     = None
         start_time = time.monotonic()
         try:
+            await self._set_server_timeout(timeout)
             cursor  = await self.conn.cursor()
-            await asyncio.wait_for(cursor.execute(query), timeout)
-            rows    = await asyncio.wait_for(cursor.fetchall(), timeout)
+            await asyncio.wait_for(cursor.execute(query), client_timeout)
+            rows    = await asyncio.wait_for(cursor.fetchall(), client_timeout)
             columns = [column[0] for column in cursor.description]
             match results_as:
                 case 'dataframe': return self._results_as_dataframe(   rows, columns)
@@ -66,9 +138,7 @@ class MysqlConnection(BaseDbConnection):
             await asyncio.sleep(random.uniform(0.1, 5))
 
         except asyncio.TimeoutError as e:
-            msg = f'{timeout}-sec timeout waiting for DB query or fetch'
-            raise AppTimeoutError(f'{msg} from resource {self.resource_id}', log_msg=msg,
-                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+            raise await self._client_timeout_error(timeout, e)
         except aiomysql.ProgrammingError as e:
             # programming errors are usually due to bad SQL syntax, not a connection issue
             msg = f'DB query error'
@@ -80,6 +150,8 @@ class MysqlConnection(BaseDbConnection):
         except aiomysql.OperationalError as e:
             # some operational errors, like 'Unknown column', are not connection issues, but
             # others, like 'Lost connection to ...', are connection issues
+            if e.args[0] in self._server_timeout_errors:
+                raise self._server_abort_error(timeout, e)
             msg = f'DB query error'
             err = e.args[1]
             if any (e in err for e in self._keep_connection_open_errors):
@@ -107,9 +179,65 @@ class MysqlConnection(BaseDbConnection):
             raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
                 log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
         finally:
-            if cursor:
+            if cursor and self.is_open:
                 await cursor.close()
             self.usage_duration += round(time.monotonic() - start_time, 3)
         msg = f'DB query error'
         raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
             log_kv_pairs=f'resource_id={self.resource_id}')
+
+    async def fetch_batches(self, query:str, batch_size=None, timeout=None):
+        ''' async generator that yields (columns, rows) tuples, up to batch_size rows at a time;
+            timeout applies to the query and to each fetch.
+            An unbuffered (server-side) cursor is used, so rows are read from the socket only
+            as they are needed. '''
+        batch_size = batch_size or config.get_int(f'{self.resource_id}__db_fetch_batch_size')
+        timeout    = timeout    or config.get_int(f'{self.resource_id}__db_default_query_timeout')
+        client_timeout = self.client_timeout(timeout)
+        cursor     = None
+        unread_results = False
+        start_time = time.monotonic()
+        try:
+            # the server-side timeout covers the whole query, including the time the client takes
+            # to read the unbuffered result set
+            await self._set_server_timeout(timeout)
+            cursor  = await self.conn.cursor(aiomysql.SSCursor)
+            await asyncio.wait_for(cursor.execute(query), client_timeout)
+            unread_results = True
+            columns = [column[0] for column in cursor.description]
+            rows    = await asyncio.wait_for(cursor.fetchmany(batch_size), client_timeout)
+            yield columns, rows
+            while len(rows) == batch_size:
+                rows = await asyncio.wait_for(cursor.fetchmany(batch_size), client_timeout)
+                if rows:
+                    yield columns, rows
+            unread_results = False
+        except asyncio.TimeoutError as e:
+            # the unbuffered result set is in an unknown state, so the connection can't be reused
+            raise await self._client_timeout_error(timeout, e)
+        except aiomysql.Error as e:
+            if e.args and e.args[0] in self._server_timeout_errors:
+                raise self._server_abort_error(timeout, e)
+            msg = f'DB query error'
+            err = str(e)
+            if any (e in err for e in self._keep_connection_open_errors):
+                conn_details = f', keeping connection {self.conn_id} open'
+            else:
+                await self.close()
+                conn_details = f', connection {self.conn_id} closed'
+            raise DatabaseError(f'{msg} for resource {self.resource_id}', log_msg=f'{msg}{conn_details}',
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        except Exception as e:
+            msg = f'DB query error'
+            raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        finally:
+            if cursor and self.is_open:
+                if unread_results:
+                    # the stream was abandoned (e.g., the client disconnected) or a fetch failed,
+                    # so rather than reading and discarding the rest of the unbuffered result set,
+                    # close the connection
+                    await self.close()
+                else:
+                    await cursor.close()
+            self.usage_duration += round(time.monotonic() - start_time, 3)
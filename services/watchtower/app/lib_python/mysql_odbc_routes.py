@@ -1,47 +1,68 @@
-from   fastapi import APIRouter, Depends, Request
-from   fastapi.responses import JSONResponse, StreamingResponse
+import datetime
+from   typing  import Literal
+from   fastapi import APIRouter, Depends, HTTPException, Request
+from   fastapi.responses import JSONResponse, Response, StreamingResponse
 from   .resource_manager import AcquiredResources, resource_manager
 from   .query  import Query
-from   .shared import init_endpoint_metric_children, convert_datetime_to_str, convert_timestamp_to_str
+from   .encoders import DELIMITERS, MEDIA_TYPES, json_dumps, negotiate_format
+from   .pagination import page_size as route_page_size
+from   .shared import init_endpoint_metric_children, convert_timestamp_to_str
 
 router      = APIRouter()
 resource_id = 'mysql_traffic'
-routes      = '/mysql-odbc-psv /mysql-odbc-json /mysql-odbc-dataframe'.split()
+routes      = '/mysql-odbc-psv /mysql-odbc-json /mysql-odbc-dataframe /mysql-odbc-window /mysql-odbc-pages'.split()
 init_endpoint_metric_children(routes)
+# dtype hints for the DataFrame columns of the tcp_hourly queries
+dtypes      = {'date_hour': 'datetime64[s]', 'port': 'int32', 'flows': 'int64', 'pkts': 'int64', 'bytes': 'int64'}
 
 @router.get('/mysql-odbc-psv', response_class=StreamingResponse,
     responses={
         200: {
-            'content': {'text/csv': {'schema': {'type': 'string'}}},
-            'description': 'returns query results as PSV, streamed' }
+            'content': {
+                'text/csv':                            {'schema': {'type': 'string'}},
+                'application/vnd.apache.arrow.stream': {'schema': {'type': 'string', 'format': 'binary'}},
+                'application/vnd.apache.parquet':      {'schema': {'type': 'string', 'format': 'binary'}}},
+            'description': 'returns query results as PSV (or CSV/TSV, see delimiter), streamed; '
+                           'quoting=minimal quotes values that contain the delimiter, a quote or a newline. '
+                           'An Arrow IPC stream or a Parquet file is returned instead if format is arrow or '
+                           'parquet, or if the Accept header asks for one of those media types' }
     })
-async def psv_request(request: Request,
+async def psv_request(request: Request, header: bool = False,
+    delimiter: Literal['pipe', 'comma', 'tab'] = 'pipe', quoting: Literal['none', 'minimal'] = 'none',
+    format: Literal['psv', 'arrow', 'parquet'] = None,
     resources: dict[str, AcquiredResources] = \
         Depends(resource_manager.acquire_resources([resource_id]))
 ):
     query = Query(request, resource_id,
         'SELECT date_hour, port, flows, pkts, bytes FROM tcp_hourly LIMIT 10')
-    await query.run(resources[resource_id].db_conn, results_as='psv')
-    # query.results is a StringIO buffer
-    return StreamingResponse(query.results, media_type='text/csv')
+    try:
+        results_as = negotiate_format(request.headers.get('accept'), format)
+    except ValueError as e:
+        raise HTTPException(406, str(e))  # 406 = not acceptable
+    # rows are fetched and sent in batches, so the results are never entirely held in memory
+    results = await query.stream(resources[resource_id].db_conn, header=header,
+                                 delimiter=DELIMITERS[delimiter], quoting=quoting,
+                                 results_as=results_as, dtypes=dtypes)
+    return StreamingResponse(results, media_type=MEDIA_TYPES[results_as])
 
 @router.get('/mysql-odbc-json', response_class=JSONResponse,
     responses={
         200: {
-            'content': {'application/json': {'schema': {'type': 'array'}}},
-            'description': 'returns query results as JSON' }
+            'content': {'application/json': {'schema': {'type': ['array', 'object']}}},
+            'description': 'returns query results as JSON, an array of objects (shape=records) '
+                           'or {"columns": [...], "rows": [[...], ...]} (shape=columns)' }
     })
-async def json_request(request: Request,
+async def json_request(request: Request, shape: Literal['records', 'columns'] = 'records',
     resources: dict[str, AcquiredResources] = \
-        Depends(resource_manager.acquire_resources([resource_id]))
+        Depends(resource_manager.acquire_resources([resource_id], lazy=True))
 ):
     query = Query(request, resource_id,
         'SELECT date_hour, port, flows, pkts, bytes FROM tcp_hourly LIMIT 10')
-    conn = resources[resource_id].db_conn
-    await query.run(conn, results_as='json')
-    # query.results is a list of dictionaries
-    convert_datetime_to_str(query.results, 'date_hour')
-    return JSONResponse(content=query.results)
+    # served from the query cache, if enabled for this route, or the slot and conn are acquired now
+    await query.fetch(resources[resource_id], results_as=f'json_{shape}')
+    await resources[resource_id].release_early()  # the results are now in memory
+    # query.results is already JSON encoded (bytes), with date_hour formatted as a string
+    return Response(query.results, media_type='application/json')
 
 @router.get('/mysql-odbc-dataframe', response_class=JSONResponse,
     responses={
@@ -51,12 +72,58 @@ async def json_request(request: Request,
     })
 async def dataframe_request(request: Request,
     resources: dict[str, AcquiredResources] = \
-        Depends(resource_manager.acquire_resources([resource_id]))
+        Depends(resource_manager.acquire_resources([resource_id], lazy=True))
 ):
     query = Query(request, resource_id,
         'SELECT date_hour, port, flows, pkts, bytes FROM tcp_hourly LIMIT 10')
-    conn = resources[resource_id].db_conn
-    await query.run(conn, results_as='dataframe')
-    # query.results is a pandas DataFrame
-    convert_timestamp_to_str(query.results, 'date_hour')
-    return JSONResponse(content=query.results.to_dict(orient='records'))
+    await query.fetch(resources[resource_id], results_as='dataframe', dtypes=dtypes)
+    await resources[resource_id].release_early()  # the results are now in memory
+    # query.results is a pandas DataFrame, which is serialized directly, without building row dicts
+    # the DataFrame may be cached, so convert a (shallow) copy
+    df = convert_timestamp_to_str(query.results.copy(deep=False), 'date_hour')
+    return Response(df.to_json(orient='records'), media_type='application/json')
+
+@router.get('/mysql-odbc-window', response_class=JSONResponse,
+    responses={
+        200: {
+            'content': {'application/json': {'schema': {'type': ['array', 'object']}}},
+            'description': 'returns the tcp_hourly rows of the last hours as JSON, in date_hour order; '
+                           'only rows newer than the last poll are read from the database' }
+    })
+async def window_request(request: Request, hours: int = 24, shape: Literal['records', 'columns'] = 'records',
+    resources: dict[str, AcquiredResources] = \
+        Depends(resource_manager.acquire_resources([resource_id], lazy=True))
+):
+    if not 1 <= hours <= 24 * 42:
+        raise HTTPException(422, 'hours must be between 1 and 1008')  # 422 = unprocessable content
+    query = Query(request, resource_id, 'SELECT date_hour, port, flows, pkts, bytes FROM tcp_hourly')
+    await query.fetch_window(resources[resource_id], 'date_hour', datetime.timedelta(hours=hours),
+                             time_type='datetime', results_as=f'json_{shape}')
+    await resources[resource_id].release_early()  # the results are now in memory
+    # query.results is already JSON encoded (bytes), date_hour formatted as a string
+    return Response(query.results, media_type='application/json')
+
+@router.get('/mysql-odbc-pages', response_class=JSONResponse,
+    responses={
+        200: {
+            'content': {'application/json': {'schema': {'type': 'object'}}},
+            'description': 'returns one page of the tcp_hourly rows, in (date_hour, port) order, as '
+                           '{"page": <as the json route, see shape>, "next_page_token": <token or null>}; '
+                           'pass next_page_token as page_token to get the next page' }
+    })
+async def pages_request(request: Request, page_size: int = None, page_token: str = None,
+    shape: Literal['records', 'columns'] = 'records',
+    resources: dict[str, AcquiredResources] = \
+        Depends(resource_manager.acquire_resources([resource_id], lazy=True))
+):
+    try:
+        page_size = route_page_size(request.url.path, page_size)
+    except ValueError as e:
+        raise HTTPException(422, str(e))  # 422 = unprocessable content
+    query = Query(request, resource_id, 'SELECT date_hour, port, flows, pkts, bytes FROM tcp_hourly')
+    # each page is a short query, so the slot and conn are only held for one page
+    await query.fetch_page(resources[resource_id], ('date_hour', 'port'), page_size, page_token,
+                           results_as=f'json_{shape}')
+    await resources[resource_id].release_early()  # the page is now in memory
+    return Response(b'{"page":' + query.results + b',"next_page_token":' +
+                    json_dumps(query.next_page_token) + b'}', media_type='application/json')
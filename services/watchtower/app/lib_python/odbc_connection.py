@@ -1,17 +1,52 @@
-import asyncio, pyodbc, time
+import asyncio, math, pyodbc, time
+from   concurrent.futures  import ThreadPoolExecutor
+from   prometheus_client   import Gauge, Histogram
 from   .base_db_connection import BaseDbConnection
 from   .exceptions         import format_exc, AppTimeoutError, DatabaseError, WithDetailsError
 from   .                   import config
 
+_executor_queue_gauge = Gauge(f'wt_odbc_executor_queued_calls',
+    'number of ODBC calls waiting for their connection thread', ['resource_id'], multiprocess_mode='livesum')
+_executor_wait_hist   = Histogram(f'wt_odbc_executor_wait_duration_seconds',
+    'time an ODBC call waited for its connection thread before it started running', ['resource_id'],
+    buckets=[0.0001, 0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10])
+
 class OdbcConnection(BaseDbConnection):
+    ''' Since pyodbc is not async, each connection has its own (single) thread that runs all of
+        its pyodbc calls, so they do not block any other asyncio tasks and do not compete with
+        other blocking calls for the threads of the default executor. '''
+    def __init__(self, resource_id: str):
+        super().__init__(resource_id)
+        self.executor       = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'odbc-{resource_id}')
+        self.cursor         = None  # the cursor of the running query, so it can be cancelled
+        self.executor_queue_gauge = _executor_queue_gauge.labels(resource_id)
+        self.executor_wait_hist   = _executor_wait_hist  .labels(resource_id)
+
+    async def _run(self, func, *args):
+        ''' runs func(*args) in this connection's thread; the time the call waits for the thread
+            (e.g., behind a call that timed out but is still running) is recorded separately from
+            the time it runs, so a starved executor can be told apart from a slow DB '''
+        submit_time = time.monotonic()
+        def timed_func():
+            self.executor_queue_gauge.dec()
+            self.executor_wait_hist.observe(time.monotonic() - submit_time)
+            return func(*args)
+        def on_done(future):
+            if future.cancelled():  # e.g., by a client timeout while still queued, so timed_func never ran
+                self.executor_queue_gauge.dec()
+        self.executor_queue_gauge.inc()
+        try:
+            future = self.executor.submit(timed_func)
+        except BaseException:  # e.g., the executor was shut down
+            self.executor_queue_gauge.dec()
+            raise
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)  # cancelling the wrapper cancels the queued call
+
     async def open(self, conn_params: dict, timeout=None):
-        loop    = asyncio.get_running_loop()
         timeout = timeout or config.get_int(f'{self.resource_id}__db_conn_timeout')
         try:
-            # since pyodbc is not async, run the connection in a separate thread
-            # so it does not block any other asyncio tasks
-            self.conn = await loop.run_in_executor(
-                None,
+            self.conn = await self._run(
                 lambda: pyodbc.connect(
                     'DRIVER='   f'{conn_params["driver"]};'
                     'SERVER='   f'{conn_params["server"]};'
@@ -35,28 +70,78 @@ class OdbcConnection(BaseDbConnection):
             msg = f'could not open a DB connection'
             raise WithDetailsError(f'{msg} to resource {self.resource_id}', log_msg=msg,
                 log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        finally:
+            if not self.is_open:
+                self.executor.shutdown(wait=False)
 
     async def close(self):
-        self.conn.close()
+        # don't wait, the thread may still be running a query that timed out; the close runs after it
         self.is_open = False
+        self.executor.submit(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+    async def _ping(self):
+        await self._run(lambda: self.conn.execute('SELECT 1').fetchall())
+
+    def _execute(self, query:str, fetch_size=None, server_timeout=0):
+        ''' Runs in this connection's thread. Executes the query and fetches all rows, or up to
+            fetch_size rows, in one hop. Returns (columns, rows). The cursor is closed once all
+            rows have been fetched, otherwise it is left open in self.cursor for _fetch().
+            server_timeout (secs, 0 = none) is the statement's query timeout (SQL_ATTR_QUERY_TIMEOUT),
+            which the driver enforces. '''
+        self.conn.timeout = math.ceil(server_timeout)  # applies to the cursors created after it is set
+        self.cursor = self.conn.cursor()
+        self.cursor.execute(query)
+        columns = [column[0] for column in self.cursor.description]
+        return columns, self._fetch(fetch_size)
+
+    def _fetch(self, fetch_size=None):
+        'runs in this connection\'s thread; see _execute()'
+        rows = self.cursor.fetchmany(fetch_size) if fetch_size else self.cursor.fetchall()
+        if not fetch_size or len(rows) < fetch_size:
+            self._close_cursor()
+        return rows
+
+    def _close_cursor(self):
+        'runs in this connection\'s thread'
+        if self.cursor:
+            cursor, self.cursor = self.cursor, None
+            cursor.close()
+
+    def _server_timeout(self, timeout):
+        return timeout if self.server_side_timeouts() else 0
+
+    def _server_abort_error(self, timeout, e):
+        self.server_aborts_counter.inc()
+        msg = f'{timeout}-sec timeout, DB query aborted by the driver/server'
+        return AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={self.resource_id} server_side_abort=true {format_exc(e)}')
+
+    async def _client_timeout_error(self, timeout, e):
+        ''' cancels the query that the client gave up on and closes the connection, since the
+            connection's thread may still be running the query '''
+        if self.cursor:
+            self.cursor.cancel()  # attempt to cancel the ongoing operation
+        await self.close()
+        msg = f'{timeout}-sec timeout waiting for DB query or fetch'
+        return AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={self.resource_id} server_side_abort=false {format_exc(e)}')
 
     _keep_connection_open_errors = ('SQL syntax', 'Unknown column', '42S02')
         # 42S02 = table not found
+    _server_timeout_error = 'HYT00'  # SQLSTATE of a query timeout
     async def execute_query(self, query:str, results_as='psv', header=False, timeout=None):
         ''' results_as: 
             - dataframe - pandas dataframe
             - json      - list[dict]
             - psv       - StringIO buffer '''
-        loop       = asyncio.get_running_loop()
-        cursor     = self.conn.cursor()
         timeout    = timeout or config.get_int(f'{self.resource_id}__db_default_query_timeout')
         start_time = time.monotonic()
         try:
-            # since pyodbc is not async, run the query and fetch in separate threads
-            # so they do not block any other asyncio tasks
-            await            asyncio.wait_for(loop.run_in_executor(None, cursor.execute, query), timeout)
-            rows     = await asyncio.wait_for(loop.run_in_executor(None, cursor.fetchall),       timeout)
-            columns  = [column[0] for column in cursor.description]
+            # execute, fetch and close the cursor in one hop to the connection's thread
+            columns, rows = await asyncio.wait_for(
+                self._run(self._execute, query, None, self._server_timeout(timeout)),
+                self.client_timeout(timeout))
             match results_as:
                 case 'dataframe': return self._results_as_dataframe(   rows, columns)
                 case 'json':      return self._results_as_json(        rows, columns)
@@ -64,13 +149,12 @@ class OdbcConnection(BaseDbConnection):
                 case _:
                     raise ValueError(f'unsupported {results_as=!s} when querying DB resource {self.resource_id}')
         except asyncio.TimeoutError as e:
-            cursor.cancel()  # attempt to cancel the ongoing operation
-            msg = f'{timeout}-sec timeout waiting for DB query'
-            raise AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
-                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+            raise await self._client_timeout_error(timeout, e)
         except pyodbc.Error as e:
             msg = f'DB query error'
             err = str(e)
+            if self._server_timeout_error in err:
+                raise self._server_abort_error(timeout, e)
             if any (keep_open_txt in err for keep_open_txt in self._keep_connection_open_errors):
                 conn_details = f', keeping connection {self.conn_id} open'
                 ##msg += f': {err}'  # maybe okay to show this DB error to the user?
@@ -84,8 +168,50 @@ class OdbcConnection(BaseDbConnection):
             raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
                 log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
         finally:
-            if cursor and self.is_open:
-                cursor.close()
+            if self.is_open:
+                # don't wait, e.g., after a timeout the query may still be running in the thread
+                self.executor.submit(self._close_cursor)
             self.usage_duration += round(time.monotonic() - start_time, 3)
         raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
             log_kv_pairs=f'resource_id={self.resource_id}')
+
+    async def fetch_batches(self, query:str, batch_size=None, timeout=None):
+        ''' async generator that yields (columns, rows) tuples, up to batch_size rows at a time;
+            timeout applies to the query and to each fetch '''
+        batch_size = batch_size or config.get_int(f'{self.resource_id}__db_fetch_batch_size')
+        timeout    = timeout    or config.get_int(f'{self.resource_id}__db_default_query_timeout')
+        client_timeout = self.client_timeout(timeout)
+        start_time = time.monotonic()
+        try:
+            # the query is executed and the first batch is fetched in one hop to the connection's
+            # thread, then each batch is fetched in its own hop, so only one batch of rows is
+            # held in memory at a time; the last fetch also closes the cursor
+            columns, rows = await asyncio.wait_for(
+                self._run(self._execute, query, batch_size, self._server_timeout(timeout)), client_timeout)
+            yield columns, rows
+            while len(rows) == batch_size:
+                rows = await asyncio.wait_for(self._run(self._fetch, batch_size), client_timeout)
+                if rows:
+                    yield columns, rows
+        except asyncio.TimeoutError as e:
+            raise await self._client_timeout_error(timeout, e)
+        except pyodbc.Error as e:
+            msg = f'DB query error'
+            err = str(e)
+            if self._server_timeout_error in err:
+                raise self._server_abort_error(timeout, e)
+            if any (keep_open_txt in err for keep_open_txt in self._keep_connection_open_errors):
+                conn_details = f', keeping connection {self.conn_id} open'
+            else:
+                await self.close()
+                conn_details = f', connection {self.conn_id} closed'
+            raise DatabaseError(f'{msg} for resource {self.resource_id}', log_msg=f'{msg}{conn_details}',
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        except Exception as e:
+            msg = f'DB query error'
+            raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        finally:
+            if self.is_open:  # e.g., the stream was abandoned or timed out; don't wait
+                self.executor.submit(self._close_cursor)
+            self.usage_duration += round(time.monotonic() - start_time, 3)
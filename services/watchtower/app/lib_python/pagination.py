@@ -0,0 +1,82 @@
+''' Keyset (seek) pagination. Rather than OFFSET, which makes the database read and discard all of
+    the preceding rows, each page is fetched with a bounded query that seeks past the key of the
+    previous page's last row:
+        SELECT * FROM (query) AS page WHERE <key > last key> ORDER BY <key> LIMIT page_size + 1
+    so every page costs about the same, however deep it is. The extra row only tells whether there
+    is a next page. The key must be unique (e.g., date_hour, port) and should be indexed.
+    The last key is returned to the client in an opaque continuation token (base64url JSON). A
+    token is bound to its query, and its values are decoded as numbers or datetimes only, so the
+    SQL literals that are built from them cannot carry SQL. '''
+import base64, datetime, hashlib, math
+import orjson
+from   .shared import sql_literal
+from   .       import config
+
+def page_size(endpoint:str, requested:int=None):
+    ''' returns requested, or the route's page size in config page_sizes if requested is None;
+        raises ValueError if the route has no page size or the result is not between 1 and
+        page_size_max '''
+    max_size = config.get_int('page_size_max')
+    if requested is None:
+        for route_size in config.get('page_sizes').split():
+            route, _, size = route_size.rpartition(':')
+            if route == endpoint:
+                requested = int(size)
+                break
+        else:
+            raise ValueError(f'no page size is configured for {endpoint}')
+    if not 1 <= requested <= max_size:
+        raise ValueError(f'page_size must be between 1 and {max_size}')
+    return requested
+
+def _query_hash(query:str, key_columns:tuple):
+    return hashlib.sha256(repr((query, key_columns)).encode()).hexdigest()[:16]
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'d': value.isoformat()}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    raise TypeError(f'unsupported keyset column type: {type(value).__name__}')
+
+def _decode_value(value):
+    if isinstance(value, dict) and len(value) == 1:
+        if 'dt' in value and isinstance(value['dt'], str):
+            return datetime.datetime.fromisoformat(value['dt'])
+        if 'd' in value and isinstance(value['d'], str):
+            return datetime.date.fromisoformat(value['d'])
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and math.isfinite(value):
+        return value
+    raise ValueError('invalid keyset value')
+
+def encode_token(query:str, key_columns:tuple, key:tuple) -> str:
+    token = orjson.dumps({'q': _query_hash(query, key_columns), 'k': [_encode_value(v) for v in key]})
+    return base64.urlsafe_b64encode(token).rstrip(b'=').decode()
+
+def decode_token(query:str, key_columns:tuple, token:str) -> tuple:
+    'returns the key in token; raises ValueError if the token is invalid or is for another query'
+    try:
+        decoded = orjson.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if decoded['q'] != _query_hash(query, key_columns) or len(decoded['k']) != len(key_columns):
+            raise ValueError
+        return tuple(_decode_value(v) for v in decoded['k'])
+    except (ValueError, TypeError, KeyError, orjson.JSONDecodeError):
+        raise ValueError('invalid page token') from None
+
+def page_query(query:str, key_columns:tuple, after:tuple, size:int):
+    ''' the query that fetches the page (plus one row) after key after, or the first page if after
+        is None; query must not have ORDER BY or LIMIT clauses, since it is used as a subquery '''
+    sql = f'SELECT * FROM ({query}) AS page'
+    if after is not None:
+        # (a, b) > (x, y) is written out as a > x OR (a = x AND b > y), which more databases can
+        # turn into an index range scan than a row value comparison
+        terms = []
+        for i, column in enumerate(key_columns):
+            equal = [f'{prev} = {sql_literal(value)}' for prev, value in zip(key_columns[:i], after)]
+            terms.append(' AND '.join(equal + [f'{column} > {sql_literal(after[i])}']))
+        sql += ' WHERE ' + ' OR '.join(f'({term})' for term in terms)
+    return sql + f' ORDER BY {", ".join(key_columns)} LIMIT {int(size) + 1}'
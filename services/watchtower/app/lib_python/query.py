@@ -1,48 +1,224 @@
-import time
+import asyncio, datetime, time
 from   fastapi             import HTTPException, Request
 from   prometheus_client   import Counter, Histogram
 from   .logging            import log, parse_kv_pairs
-from   .exceptions         import AppTimeoutError, DatabaseError, WithDetailsError
+from   .exceptions         import AppTimeoutError, DatabaseError, WithDetailsError, format_exc
 from   .base_db_connection import BaseDbConnection
-from   .shared             import get_cid
+from   .resource_manager   import AcquiredResources, resource_manager
+from   .dataframes         import DataFrameBuilder
+from   .encoders           import ENCODE_ERRORS, json_dumps, json_encode_rows, ArrowEncoder, PsvEncoder
+from   .query_cache        import normalize_sql, query_cache
+from   .time_series        import TimeSeriesWindow, windows
+from   .pagination         import decode_token, encode_token, page_query
+from   .shared             import BACKGROUND_TASK_NAME_PREFIX, deadline_var, get_cid
+from   .                   import config, deadlines
 
 _queries_counter      = Counter(  'wt_queries_total',      'total number of queries',      ['resource_id'])
 _query_errors_counter = Counter(  'wt_query_errors_total', 'total number of query errors', ['resource_id', 'error_type'])
+_queries_coalesced_counter = Counter('wt_queries_coalesced_total',
+    'queries not run because an identical query was already running; its results were shared', ['resource_id'])
 _query_duration_hist  = Histogram('wt_query_duration_seconds', 'duration to run a query',  ['resource_id'],
                                   # you may want to adjust the buckets
                                   buckets=[0.001, 0.05, 0.1, 0.5, 1, 5, 10, 20])
 _query_rows_hist      = Histogram('wt_query_rows', 'number of rows returned by a query', ['resource_id'],
                                     # you may want to adjust the buckets
                                     buckets=[1, 10, 100, 500, 1000, 5000, 10000, 100000])
+# (resource_id, normalized SQL, results_as) -> future that is set to (results, row_count)
+_in_flight_queries: dict[tuple, asyncio.Future] = {}
 
 class Query:
     def __init__(self, request:Request, resource_id:str, query:str):
-        request.state.queries.append(self)
+        'request is None for queries that are run by background tasks--e.g., to refresh cached results'
+        if request:
+            request.state.queries.append(self)
         self.resource_id         = resource_id
         self.query               = query
+        self.endpoint            = request.url.path if request else None
+        self.cached              = False  # True if the results were served from the query cache
+        self.coalesced           = False  # True if the results were shared by an identical running query
+        self.next_page_token     = None   # set by fetch_page() if there is a next page
         self.results             = None
+        self.row_count           = None  # set if results is not a list or DataFrame of rows
         self.conn_id             = -1
         self.duration            = -1
         self.queries_counter     = _queries_counter    .labels(resource_id)
+        self.queries_coalesced_counter = _queries_coalesced_counter.labels(resource_id)
         self.query_duration_hist = _query_duration_hist.labels(resource_id)
         self.query_rows_hist     = _query_rows_hist    .labels(resource_id)
         # initialize children for metrics that have more than one label
         _query_errors_counter.labels(resource_id, 'timeout')
         _query_errors_counter.labels(resource_id, 'other')
+        query_cache.init_metric_children(resource_id)
 
-    async def run(self, db_conn:BaseDbConnection, results_as='psv', header=False, timeout=None):
+    async def fetch(self, resources:AcquiredResources, results_as='json_records', timeout=None, dtypes=None):
+        ''' Like run(), but if the route has a TTL in config query_cache_ttls, the results are
+            served from the query cache when possible, without acquiring a request slot or a DB
+            connection. Otherwise resources.acquire() is called and the query is run, and the
+            results are cached. Use acquire_resources(..., lazy=True) to get resources.
+            If <resource_id>__coalesce_queries is enabled and an identical query (same resource_id,
+            normalized SQL and results_as) is already running, its results are awaited and shared
+            instead, again without acquiring a slot or a connection.
+            If the cached results are stale (expired less than query_cache_stale_ttl secs ago), they
+            are served anyway and a background task refreshes them.
+            Cached and shared results must not be modified in place by a route handler. '''
+        ttl = query_cache.ttl(self.endpoint)
+        key = query_cache.key(self.resource_id, self.query, results_as)
+        if ttl:
+            cached = await query_cache.get(key)
+            if cached:
+                self.results, self.row_count, stale = cached
+                self.cached   = True
+                self.duration = 0
+                if stale:
+                    refresh_in_background(self.resource_id, self.query, results_as, ttl, timeout, dtypes)
+                return
+        await self._fetch_coalesced(resources, results_as, timeout, dtypes, ttl, key)
+
+    async def _fetch_coalesced(self, resources:AcquiredResources, results_as, timeout, dtypes, ttl, key):
+        if not config.getbool(f'{self.resource_id}__coalesce_queries'):
+            await self._fetch_from_db(resources, results_as, timeout, dtypes, ttl, key)
+            return
+        while in_flight := _in_flight_queries.get(key):
+            start_time = time.monotonic()
+            try:
+                # shield: if this request is cancelled or its deadline passes, the in-flight query
+                # must not be
+                self.results, self.row_count = await asyncio.wait_for(asyncio.shield(in_flight),
+                                                                      deadlines.remaining())
+            except asyncio.CancelledError:
+                if in_flight.cancelled():
+                    continue  # the request running the query was cancelled, so run it again
+                raise
+            except asyncio.TimeoutError:
+                msg = 'request deadline passed while waiting for an identical running query'
+                log.error('query-timeout', msg, resource_id=self.resource_id, cid=get_cid())
+                raise HTTPException(504, f'{msg} for resource {self.resource_id}')  # 504 = gateway timeout
+            self.coalesced = True
+            self.duration  = round(time.monotonic() - start_time, 3)
+            self.queries_coalesced_counter.inc()
+            return
+        in_flight = asyncio.get_running_loop().create_future()
+        _in_flight_queries[key] = in_flight
+        try:
+            await self._fetch_from_db(resources, results_as, timeout, dtypes, ttl, key)
+            in_flight.set_result((self.results, self.row_count))
+        except asyncio.CancelledError:
+            in_flight.cancel()
+            raise
+        except Exception as e:  # e.g., a FastAPI HTTPException; requests waiting on in_flight get it too
+            in_flight.set_exception(e)
+            in_flight.exception()  # marks the exception as retrieved, in case no requests are waiting
+            raise
+        finally:
+            del _in_flight_queries[key]
+
+    async def _fetch_from_db(self, resources:AcquiredResources, results_as, timeout, dtypes, ttl, key):
+        await resources.acquire()
+        await self.run(resources.db_conn, results_as=results_as, timeout=timeout, dtypes=dtypes)
+        if ttl:
+            await query_cache.put(key, self.results, self.row_count, ttl)
+
+    async def fetch_window(self, resources:AcquiredResources, time_column:str, window:datetime.timedelta,
+                           time_type='datetime', results_as='json_records', timeout=None, dtypes=None):
+        ''' For append-only time-series tables: self.query (without WHERE or ORDER BY clauses, since
+            it is used as a subquery) is materialized as a TimeSeriesWindow of the rows whose
+            time_column is within window of now, and only the rows that are newer than the
+            window's latest time are fetched from the DB. time_type is the type of time_column:
+            datetime (a naive datetime in local time) or epoch (int secs). results_as can be
+            json_records, json_columns or dataframe. Requests for the same query share one window,
+            as long as the longest window requested, and a shorter window is a slice of it. If a
+            request refreshed the window while this one waited for it, the window is served without
+            acquiring a request slot or a DB connection. The results must not be modified in
+            place by a route handler. '''
+        key   = (self.resource_id, normalize_sql(self.query), time_column)
+        start = time.monotonic()
+        def window_start(window):
+            if time_type == 'epoch':
+                return int(time.time() - window.total_seconds())
+            return datetime.datetime.now() - window
+        ts_window = windows.setdefault(key, TimeSeriesWindow(self.query, time_column))
+        try:
+            # the wait for a refresh by another request must not outlast this request's deadline
+            await asyncio.wait_for(ts_window.lock.acquire(), deadlines.remaining())
+        except asyncio.TimeoutError:
+            msg = 'request deadline passed while waiting for the time-series window to be refreshed'
+            log.error('query-timeout', msg, resource_id=self.resource_id, cid=get_cid())
+            raise HTTPException(504, f'{msg} for resource {self.resource_id}')  # 504 = gateway timeout
+        try:
+            ts_window.extend_window(window)
+            held_start = window_start(ts_window.window)
+            if ts_window.refreshed_time_mono < start:
+                await resources.acquire()
+                delta = Query(None, self.resource_id, ts_window.delta_query(held_start))
+                await delta.run(resources.db_conn, results_as='rows', timeout=timeout)
+                ts_window.update(*delta.results, held_start)
+                ts_window.refreshed_time_mono = time.monotonic()
+                self.conn_id  = delta.conn_id
+                self.duration = delta.duration
+            else:
+                ts_window.update(ts_window.columns, [], held_start)  # trim only
+                self.coalesced = True
+            first_row      = ts_window.first_index(window_start(window))
+            self.results   = ts_window.results(results_as, first_row, dtypes)
+            self.row_count = len(ts_window.rows) - first_row
+        finally:
+            ts_window.lock.release()
+
+    async def fetch_page(self, resources:AcquiredResources, key_columns:tuple, page_size:int, page_token=None,
+                         results_as='json_records', timeout=None):
+        ''' Fetches one page of self.query (without ORDER BY or LIMIT clauses, since it is used as a
+            subquery) with keyset pagination, ordered by key_columns, which must be unique and be
+            in the select list; see pagination.py. page_token is the next_page_token of the
+            previous page, or None for the first page. self.results is the page as json_records
+            or json_columns (bytes), and self.next_page_token is set if there is a next page.
+            A FastAPI HTTPException (400) is raised if page_token is invalid. '''
+        try:
+            after = decode_token(self.query, key_columns, page_token) if page_token else None
+        except ValueError as e:
+            raise HTTPException(400, str(e))  # 400 = bad request
+        await resources.acquire()
+        page = Query(None, self.resource_id, page_query(self.query, key_columns, after, page_size))
+        await page.run(resources.db_conn, results_as='rows', timeout=timeout)
+        columns, rows = page.results
+        if len(rows) > page_size:
+            del rows[page_size:]
+            key_indexes = [columns.index(column) for column in key_columns]
+            self.next_page_token = encode_token(self.query, key_columns,
+                                                tuple(rows[-1][i] for i in key_indexes))
+        if results_as == 'json_records':
+            self.results = b'[' + json_encode_rows(rows, columns) + b']'
+        else:
+            self.results = b'{"columns":' + json_dumps(columns) + b',"rows":[' + json_encode_rows(rows) + b']}'
+        self.row_count = len(rows)
+        self.conn_id   = page.conn_id
+        self.duration  = page.duration
+
+    async def run(self, db_conn:BaseDbConnection, results_as='psv', header=False, timeout=None, dtypes=None):
         ''' Runs the query and stores the results in self.results or a FastAPI
             HTTPException is raised. results_as can be one of the following: 
-            - dataframe - pandas dataframe
-            - json      - list[dict]
-            - psv       - StringIO buffer '''
+            - dataframe    - pandas dataframe, built column by column as rows are fetched;
+                             dtypes optionally maps column names to NumPy dtypes
+            - json         - list[dict]
+            - json_records - JSON bytes, an array of objects (the same shape as json)
+            - json_columns - JSON bytes, {"columns": [...], "rows": [[...], ...]}
+            - psv          - StringIO buffer
+            - rows         - (columns, list of row tuples) '''
+        timeout      = self._deadline_timeout(timeout)
         self.queries_counter.inc()
         start_time   = time.monotonic()
         self.conn_id = db_conn.conn_id
         try:
-            self.results = await db_conn.execute_query(
-                self.query, results_as=results_as, header=header, timeout=timeout)
+            if results_as == 'dataframe':
+                self.results = await self._fetch_dataframe(db_conn, dtypes, timeout)
+            elif results_as in ('json_records', 'json_columns'):
+                self.results = await self._fetch_json(db_conn, results_as == 'json_records', timeout)
+            elif results_as == 'rows':
+                self.results = await self._fetch_rows(db_conn, timeout)
+            else:
+                self.results = await db_conn.execute_query(
+                    self.query, results_as=results_as, header=header, timeout=timeout)
         except AppTimeoutError as e:
+            deadlines.observe(self.resource_id, 'query', time.monotonic() - start_time)
             log.error('query-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
             _query_errors_counter.labels(self.resource_id, 'timeout')
             raise HTTPException(504, str(e))  # 504 = gateway timeout
@@ -50,8 +226,186 @@ class Query:
             log.error('query-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
             _query_errors_counter.labels(self.resource_id, 'other')
             raise HTTPException(500, str(e))  # 500 = internal server error
+        else:
+            deadlines.observe(self.resource_id, 'query', time.monotonic() - start_time)
         finally:
             self.duration = round(time.monotonic() - start_time, 3)
             self.query_duration_hist.observe(self.duration)
-            if hasattr(self.results, '__len__'):
+            resource_manager.request_limiters[self.resource_id].record_query_duration(self.duration)
+            if self.row_count is not None:
+                self.query_rows_hist.observe(self.row_count)
+            elif hasattr(self.results, '__len__'):
                 self.query_rows_hist.observe(len(self.results))
+
+    def _deadline_timeout(self, timeout):
+        ''' returns the query timeout, shortened to the time remaining until the request deadline,
+            or raises a FastAPI HTTPException if the query would most likely not finish in time '''
+        try:
+            deadlines.admit(self.resource_id, 'query')
+        except AppTimeoutError as e:
+            log.error('query-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            raise HTTPException(504, str(e))  # 504 = gateway timeout
+        return deadlines.bounded_timeout(
+            timeout or config.get_int(f'{self.resource_id}__db_default_query_timeout'))
+
+    async def _fetch_dataframe(self, db_conn:BaseDbConnection, dtypes, timeout):
+        builder = None
+        async for columns, rows in db_conn.fetch_batches(self.query, timeout=timeout):
+            if builder is None:
+                builder = DataFrameBuilder(columns, dtypes, capacity=max(len(rows), 1))
+            builder.append(rows)
+        return builder.to_dataframe()
+
+    async def _fetch_rows(self, db_conn:BaseDbConnection, timeout):
+        rows = []
+        async for columns, batch in db_conn.fetch_batches(self.query, timeout=timeout):
+            rows.extend(batch)
+        self.row_count = len(rows)
+        return columns, rows
+
+    async def _fetch_json(self, db_conn:BaseDbConnection, as_records:bool, timeout):
+        ''' Encodes each batch of rows with orjson as it is fetched, straight from the row tuples
+            when as_records is False. Datetimes are formatted as '%Y-%m-%d %H:%M:%S' strings. '''
+        self.row_count = 0
+        encoded_batches = []
+        async for columns, rows in db_conn.fetch_batches(self.query, timeout=timeout):
+            self.row_count += len(rows)
+            if rows:
+                encoded_batches.append(json_encode_rows(rows, columns if as_records else None))
+        if as_records:
+            return b'[' + b','.join(encoded_batches) + b']'
+        return b'{"columns":' + json_dumps(columns) + b',"rows":[' + b','.join(encoded_batches) + b']}'
+
+    async def stream(self, db_conn:BaseDbConnection, header=False, timeout=None, delimiter='|', quoting='none',
+                     results_as='psv', dtypes=None):
+        ''' Runs the query and returns an async generator that yields the results as bytes, as rows
+            are fetched from the DB. results_as can be one of the following:
+            - psv     - PSV (or CSV/TSV, see PsvEncoder), in chunks of about
+                        <resource_id>__psv_chunk_size bytes
+            - arrow   - an Arrow IPC stream, one record batch per fetched batch
+            - parquet - a Parquet file, see ArrowEncoder
+            dtypes optionally maps column names to NumPy dtypes, for the arrow/parquet schema.
+            The first batch is fetched and encoded
+            before this method returns, so that query and encoding errors can still result in a
+            FastAPI HTTPException. An error that occurs after that can only be logged and the
+            response truncated, since the status code has already been sent. '''
+        timeout      = self._deadline_timeout(timeout)
+        self.queries_counter.inc()
+        start_time   = time.monotonic()
+        self.conn_id = db_conn.conn_id
+        row_count    = 0
+        batches      = db_conn.fetch_batches(self.query, timeout=timeout)
+        if results_as == 'psv':
+            encoder  = PsvEncoder(config.get_int(f'{self.resource_id}__psv_chunk_size'),
+                                  delimiter=delimiter, header=header, quoting=quoting)
+        else:
+            encoder  = ArrowEncoder(results_as, dtypes)
+
+        def record_stats():
+            self.duration = round(time.monotonic() - start_time, 3)
+            self.query_duration_hist.observe(self.duration)
+            self.query_rows_hist.observe(row_count)
+
+        def log_encode_error(e:Exception, **kv_pairs):
+            log.error('encode-err', f'unable to encode results as {results_as}', exception=f'{format_exc(e)}',
+                      resource_id=f'{self.resource_id}', **kv_pairs, cid=get_cid())
+            _query_errors_counter.labels(self.resource_id, 'other').inc()
+
+        try:
+            columns, rows = await anext(batches)
+            row_count     = len(rows)
+            first_chunks  = encoder.encode(rows, columns)
+        except AppTimeoutError as e:
+            log.error('query-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            _query_errors_counter.labels(self.resource_id, 'timeout').inc()
+            record_stats()
+            raise HTTPException(504, str(e))  # 504 = gateway timeout
+        except (DatabaseError, WithDetailsError) as e:
+            log.error('query-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            _query_errors_counter.labels(self.resource_id, 'other').inc()
+            record_stats()
+            raise HTTPException(500, str(e))  # 500 = internal server error
+        except ENCODE_ERRORS as e:
+            log_encode_error(e)
+            await batches.aclose()
+            record_stats()
+            raise HTTPException(500, f'unable to encode the results as {results_as}: {e}')
+
+        async def stream_results():
+            nonlocal row_count
+            try:
+                for chunk in first_chunks:
+                    yield chunk
+                async for _, more_rows in batches:
+                    row_count += len(more_rows)
+                    for chunk in encoder.encode(more_rows, columns):
+                        yield chunk
+                if chunk := encoder.flush():
+                    yield chunk
+            except AppTimeoutError as e:
+                log.error('query-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs),
+                          rows_sent=row_count, cid=get_cid())
+                _query_errors_counter.labels(self.resource_id, 'timeout').inc()
+                raise
+            except (DatabaseError, WithDetailsError) as e:
+                log.error('query-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs),
+                          rows_sent=row_count, cid=get_cid())
+                _query_errors_counter.labels(self.resource_id, 'other').inc()
+                raise
+            except ENCODE_ERRORS as e:
+                log_encode_error(e, rows_sent=row_count)
+                raise
+            finally:
+                await batches.aclose()
+                record_stats()
+        return stream_results()
+
+_refreshing_queries: set[tuple] = set()  # keys of the queries being refreshed by background tasks
+
+def refresh_in_background(resource_id:str, query:str, results_as:str, ttl:float, timeout=None, dtypes=None):
+    ''' Starts a background task that runs the query through the normal pool and caches its
+        results for ttl secs, unless the query is already being refreshed. '''
+    key = query_cache.key(resource_id, query, results_as)
+    if key in _refreshing_queries:
+        return
+    _refreshing_queries.add(key)
+
+    async def refresh():
+        deadline_var.set(None)  # the task's context is a copy of the request's, with its deadline
+        resources = AcquiredResources(resource_id)
+        try:
+            await Query(None, resource_id, query)._fetch_coalesced(
+                resources, results_as, timeout, dtypes, ttl, key)
+        except HTTPException:
+            pass  # already logged; stale results are served until they are too old
+        except Exception as e:
+            log.error('refresh-err', f'unable to refresh cached results for resource {resource_id}',
+                      exception=f'{format_exc(e)}')
+        finally:
+            await resources.release()
+            _refreshing_queries.discard(key)
+    asyncio.create_task(refresh(), name=f'{BACKGROUND_TASK_NAME_PREFIX}-refresh-{resource_id}')
+
+async def prewarm_queries():
+    ''' Refreshes the results of the <resource_id>__query_cache_prewarm queries that are not cached
+        or are stale, in background tasks. Each line of that config is a route, a results_as
+        (json_records or json_columns) and the query, and the route's TTL in query_cache_ttls is
+        used. Called periodically by lifecycle.background_coroutine(), starting at startup. '''
+    for resource_id in config.get('resource_ids').split():
+        for line in config.get(f'{resource_id}__query_cache_prewarm').splitlines():
+            if not line.strip():
+                continue
+            fields = line.split(maxsplit=2)
+            if len(fields) < 3:
+                log.warning('prewarm-skip', 'prewarm line must be a route, a results_as and a query',
+                            resource_id=resource_id, line=line.strip())
+                continue
+            route, results_as, query = fields
+            ttl = query_cache.ttl(route)
+            if not ttl or results_as not in ('json_records', 'json_columns'):
+                log.warning('prewarm-skip', 'query cannot be prewarmed, check the route and results_as',
+                            resource_id=resource_id, route=route, results_as=results_as)
+                continue
+            cached = await query_cache.get(query_cache.key(resource_id, query, results_as), count=False)
+            if not cached or cached[2]:  # not cached or stale
+                refresh_in_background(resource_id, query, results_as, ttl)
@@ -0,0 +1,131 @@
+''' An in-process (per worker) cache of query results, keyed by resource_id, normalized SQL and
+    result format. Entries expire after the TTL configured for the route (config query_cache_ttls)
+    and the least recently used entries are evicted once the cached results exceed
+    query_cache_max_bytes. A cache hit is served without acquiring a request slot or a DB connection.
+    Expired entries are kept for another query_cache_stale_ttl secs, during which they are returned
+    as stale, so they can be served while they are refreshed (see Query.fetch()).
+    If query_cache_shared_max_bytes is set, results that are already encoded (bytes) are instead
+    cached in the SharedQueryCache, which all of the workers use; its blocking file I/O runs in a
+    thread, so get() and put() are async. '''
+import asyncio, re, sys, time
+from   collections       import OrderedDict
+from   prometheus_client import Counter, Gauge
+import pandas as pd
+from   .shared_query_cache import shared_query_cache
+from   .                   import config
+
+_cache_hits_counter      = Counter('wt_query_cache_hits_total',      'query results served from the cache',
+                                   ['resource_id'])
+_cache_misses_counter    = Counter('wt_query_cache_misses_total',    'cacheable queries not found in the cache',
+                                   ['resource_id'])
+_cache_evictions_counter = Counter('wt_query_cache_evictions_total', 'cached results evicted to stay under '
+                                   'query_cache_max_bytes or query_cache_shared_max_bytes', ['resource_id'])
+_cache_bytes_gauge       = Gauge(  'wt_query_cache_bytes', 'bytes of cached query results',
+                                   multiprocess_mode='livesum')
+
+def normalize_sql(query:str):
+    ''' collapses whitespace and removes a trailing semicolon, so trivially different spellings of a
+        query share a cache entry; case is kept, since it matters inside string literals '''
+    return re.sub(r'\s+', ' ', query).strip().rstrip(';').rstrip()
+
+def result_size(results):
+    'approximate number of bytes a result holds'
+    if isinstance(results, pd.DataFrame):
+        return int(results.memory_usage(index=True, deep=True).sum())
+    return sys.getsizeof(results)
+
+class _Entry:
+    __slots__ = ('results', 'row_count', 'size', 'expiry_time_mono')
+
+    def __init__(self, results, row_count, size, expiry_time_mono):
+        self.results          = results
+        self.row_count        = row_count
+        self.size             = size
+        self.expiry_time_mono = expiry_time_mono
+
+class QueryCache:
+    def __init__(self):
+        self.entries: OrderedDict[tuple, _Entry] = OrderedDict()  # least recently used first
+        self.size = 0
+
+    @staticmethod
+    def ttl(endpoint:str):
+        'returns the TTL (secs) configured for the route, or 0 if its results must not be cached'
+        if config.get_eval('query_cache_max_bytes') <= 0 and not shared_query_cache.enabled():
+            return 0
+        for route_ttl in config.get('query_cache_ttls').split():
+            route, _, ttl = route_ttl.rpartition(':')
+            if route == endpoint:
+                return float(ttl)
+        return 0
+
+    @staticmethod
+    def stale_ttl():
+        'secs that expired results are kept and can still be served while they are refreshed'
+        return config.get_float('query_cache_stale_ttl')
+
+    @staticmethod
+    def key(resource_id:str, query:str, results_as:str):
+        return (resource_id, normalize_sql(query), results_as)
+
+    async def get(self, key:tuple, count=True):
+        ''' returns (results, row_count, stale) for an entry that has not expired or is stale, or
+            None; hits and misses are counted if count is True '''
+        entry = self.entries.get(key)
+        now   = time.monotonic()
+        if entry and entry.expiry_time_mono + self.stale_ttl() <= now:
+            self._remove(key)
+            entry = None
+        if entry:
+            self.entries.move_to_end(key)
+            cached = entry.results, entry.row_count, entry.expiry_time_mono <= now
+        elif shared_query_cache.enabled():
+            cached = await asyncio.to_thread(shared_query_cache.get, key, self.stale_ttl())
+        else:
+            cached = None
+        if count:
+            counter = _cache_hits_counter if cached else _cache_misses_counter
+            counter.labels(key[0]).inc()
+        return cached
+
+    async def put(self, key:tuple, results, row_count, ttl:float):
+        ''' caches results for ttl secs; results larger than query_cache_max_bytes are not cached.
+            Cached results are shared by all requests that hit them, so they must not be modified. '''
+        if isinstance(results, bytes) and shared_query_cache.enabled():
+            evicted = await asyncio.to_thread(shared_query_cache.put, key, results, row_count, ttl,
+                                              self.stale_ttl())
+            for resource_id in evicted:
+                _cache_evictions_counter.labels(resource_id).inc()
+            return
+        max_bytes = config.get_eval('query_cache_max_bytes')
+        size      = result_size(results)
+        if key in self.entries:
+            self._remove(key)
+        if size > max_bytes:
+            return
+        while self.size + size > max_bytes:
+            # expired entries would otherwise only be removed when they are next looked up
+            now     = time.monotonic() - self.stale_ttl()
+            expired = [k for k, entry in self.entries.items() if entry.expiry_time_mono <= now]
+            for expired_key in expired:
+                self._remove(expired_key)
+            if expired:
+                continue
+            lru_key = next(iter(self.entries))
+            self._remove(lru_key)
+            _cache_evictions_counter.labels(lru_key[0]).inc()
+        self.entries[key] = _Entry(results, row_count, size, time.monotonic() + ttl)
+        self.size += size
+        _cache_bytes_gauge.inc(size)
+
+    def _remove(self, key:tuple):
+        entry      = self.entries.pop(key)
+        self.size -= entry.size
+        _cache_bytes_gauge.dec(entry.size)
+
+    def init_metric_children(self, resource_id:str):
+        _cache_hits_counter     .labels(resource_id)
+        _cache_misses_counter   .labels(resource_id)
+        _cache_evictions_counter.labels(resource_id)
+
+query_cache = QueryCache()
@@ -0,0 +1,81 @@
+''' Per-client (and per API key) rate limiting, ahead of the per-resource RequestLimiter, so that
+    one noisy client cannot fill all of the pending request slots of a resource_id.
+    Each key gets a token bucket, implemented with GCRA (the generic cell rate algorithm): the
+    only state per key is its theoretical arrival time (TAT), the time at which its bucket will be
+    full again. The TATs are kept in a fixed-size array of floats (rate_limit_table_size entries,
+    8 bytes each) indexed by the key's hash, rather than in a dict, so memory stays the same no
+    matter how many distinct clients there are and nothing needs to be expired: a TAT in the past
+    is simply a full bucket. Keys can share a slot, so each key uses two slots and the least
+    loaded one decides; a key is only limited too early if both of its slots are shared with keys
+    that are using up their own rate. State is per worker. '''
+import time
+from   array             import array
+from   prometheus_client import Counter
+from   .                 import config
+
+_rate_limited_counter = Counter('wt_rate_limited_requests_total', 'requests rejected by the per-client rate limiter',
+    ['key_type'])
+_CONFIG_READ_INTERVAL = 1  # secs; configs are cached, since reading them costs more than a decision
+
+class RateLimiter:
+    def __init__(self):
+        self.size = 0
+        self.configs_read_time_mono = 0.0
+        # initialize children for metrics that have labels
+        for key_type in ('client', 'api_key'):
+            _rate_limited_counter.labels(key_type)
+
+    def _read_configs(self, now:float):
+        self.configs_read_time_mono = now
+        self.api_key_header = config.get('rate_limit_api_key_header')
+        self.limits = {}  # key_type -> (emission interval, burst tolerance) in secs, if enabled
+        for key_type in ('client', 'api_key'):
+            rate  = config.get_float(f'rate_limit_{key_type}_rate')
+            burst = config.get_float(f'rate_limit_{key_type}_burst')
+            if rate > 0:
+                self.limits[key_type] = (1 / rate, (max(burst, 1) - 1) / rate)
+        size = config.get_eval('rate_limit_table_size')
+        if self.limits and size != self.size:  # the table is only allocated once a limit is enabled
+            self.size = size
+            self.tats = array('d', bytes(8 * size))  # 0.0 is in the past, i.e., every bucket is full
+
+    def check(self, client:str, headers):
+        ''' returns 0 if the request is allowed, otherwise the secs after which it would be (for a
+            Retry-After header); the client's bucket and, if the request has an API key, the key's
+            bucket must both have a token. Both are checked before a token is taken from either, so
+            a request that one bucket rejects does not use up the other one's tokens. '''
+        now = time.monotonic()
+        if now - self.configs_read_time_mono >= _CONFIG_READ_INTERVAL:
+            self._read_configs(now)
+        if not self.limits:
+            return 0
+        keys = []
+        if 'client' in self.limits:
+            keys.append(('client', f'c:{client}'))
+        if 'api_key' in self.limits and self.api_key_header and (api_key := headers.get(self.api_key_header)):
+            keys.append(('api_key', f'k:{api_key}'))
+        takes = []
+        for key_type, key in keys:
+            retry_after, take = self._check(key, *self.limits[key_type], now)
+            if retry_after:
+                _rate_limited_counter.labels(key_type).inc()
+                return retry_after
+            takes.append(take)
+        tats = self.tats
+        for i, j, tat in takes:
+            if tats[i] < tat:  tats[i] = tat
+            if tats[j] < tat:  tats[j] = tat
+        return 0
+
+    def _check(self, key:str, emission_interval:float, burst_tolerance:float, now:float):
+        ''' returns (secs until the key's bucket has a token, None) if it is empty, otherwise
+            (0, (slot, slot, TAT after a token is taken)) '''
+        tats = self.tats
+        h    = hash(key)
+        i, j = h % self.size, (h >> 32) % self.size
+        tat  = max(min(tats[i], tats[j]), now)
+        if tat - now > burst_tolerance:
+            return tat - now - burst_tolerance, None
+        return 0, (i, j, tat + emission_interval)
+
+rate_limiter = RateLimiter()
@@ -1,7 +1,8 @@
-import asyncio, time
+import asyncio, collections, functools, math, time
 from   prometheus_client import Counter, Gauge, Histogram
-from   .           import config
-from   .shared     import shutdown_event
+from   .           import config, deadlines
+from   .logging    import log
+from   .shared     import BACKGROUND_TASK_NAME_PREFIX, request_class_var, shutdown_event
 from   .exceptions import format_exc, AppTimeoutError, ResourceError
 
 _pending_requests_gauge     = Gauge('wt_pending_requests',           'number of pending requests',
@@ -18,13 +19,78 @@ _request_slot_error_counter = Counter('wt_request_slot_errors_total','total numb
     ['resource_id', 'error_type'])
 _request_slot_acquire_durations  = Histogram('wt_request_slot_acquire_duration_seconds',
     'duration to acquire a request slot', ['resource_id'], buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20])
+_class_pending_requests_gauge     = Gauge('wt_class_pending_requests', 'number of pending requests per request class',
+    ['resource_id', 'request_class'], multiprocess_mode='livesum')
+_class_in_progress_requests_gauge = Gauge('wt_class_in_progress_requests',
+    'number of in progress requests per request class', ['resource_id', 'request_class'], multiprocess_mode='livesum')
+_class_request_slot_error_counter = Counter('wt_class_request_slot_errors_total',
+    'total number of request slot errors per request class', ['resource_id', 'request_class', 'error_type'])
+_class_request_slot_acquire_durations = Histogram('wt_class_request_slot_acquire_duration_seconds',
+    'duration to acquire a request slot per request class', ['resource_id', 'request_class'],
+    buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20])
+_request_limit_gauge = Gauge('wt_request_limit', 'max active requests, as adjusted by the adaptive limiter',
+    ['resource_id'], multiprocess_mode='livesum')
+_request_limit_adjustments_counter = Counter('wt_request_limit_adjustments_total',
+    'adaptive limiter adjustments of max active requests', ['resource_id', 'direction'])
+_request_limit_latency_gauge = Gauge('wt_request_limit_latency_seconds',
+    'query latency the adaptive limiter last saw: the interval average (sample) and the baseline',
+    ['resource_id', 'window'], multiprocess_mode='mostrecent')
+
+_LIMIT_SMOOTHING     = 0.2  # fraction of the gradient's new limit that is applied per interval
+_BASELINE_PERCENTILE = 0.1  # the baseline is this percentile of the recent interval latencies
+
+def _config_pairs(key:str, convert=float, positive=False):
+    ''' parses a config of space-separated name:value pairs--e.g., request_class:weight. The parse
+        is cached per config value, since some of these are read on every request, so the returned
+        dict must not be modified. If positive is True, values must be greater than 0. '''
+    return _parse_pairs(key, config.get(key), convert, positive)
+
+@functools.lru_cache(maxsize=64)
+def _parse_pairs(key:str, text:str, convert, positive:bool):
+    values = {}
+    for name_value in text.split():
+        name, _, value = name_value.rpartition(':')
+        values[name] = convert(value)
+        if positive and not values[name] > 0:
+            raise ValueError(f'config {key}: the value of {name} must be greater than 0, not {value}')
+    return values
+
+def request_class(path:str, headers):
+    ''' returns the request class of a request: the one named in the request_class_header header,
+        if it is a configured class, otherwise the route's class in request_class_routes, otherwise
+        the first class in request_classes '''
+    classes = _config_pairs('request_classes', str)  # only the names are needed
+    if (header := config.get('request_class_header')) and headers.get(header) in classes:
+        return headers.get(header)
+    return _config_pairs('request_class_routes', str).get(path) or next(iter(classes))
+
+class _RequestClass:
+    def __init__(self, resource_id:str, name:str, weight:float):
+        self.name     = name
+        self.weight   = weight
+        self.waiters  = collections.deque()  # futures of the requests waiting for a slot, FIFO
+        self.pass_    = 0.0  # WFQ virtual time; the class with the lowest pass gets the next slot
+        self.pending_requests_count = 0
+        self.pending_requests_gauge         = _class_pending_requests_gauge        .labels(resource_id, name)
+        self.in_progress_requests_gauge     = _class_in_progress_requests_gauge    .labels(resource_id, name)
+        self.request_slot_acquire_durations = _class_request_slot_acquire_durations.labels(resource_id, name)
+        # initialize children for metrics that have more than one label
+        _class_request_slot_error_counter.labels(resource_id, name, 'timeout')
+        _class_request_slot_error_counter.labels(resource_id, name, 'overload')
 
 class RequestLimiter:
-    'limits/throttles client requests for a particular database resource'
+    ''' Limits/throttles client requests for a particular database resource. Pending requests are
+        queued per request class (config request_classes) and, when a slot is freed, it is granted
+        to the first request of the class chosen by request_class_policy:
+        - wfq      - weighted fair queuing: while classes are backlogged, each gets slots in
+                     proportion to its weight (stride scheduling)
+        - priority - strict priority: the first class listed in request_classes that has pending
+                     requests
+        Each class has its own max pending requests and slot timeout, see
+        <resource_id>__request_class_max_pending and <resource_id>__request_class_slot_timeouts. '''
 
     def __init__(self, resource_id: str):
         self.resource_id = resource_id
-        self.lock        = asyncio.Lock()
         self.pending_requests_count = 0
         self.active_requests_count  = 0
         self.pending_requests_gauge         = _pending_requests_gauge        .labels(resource_id)
@@ -33,48 +99,196 @@ class RequestLimiter:
         self.last_response_time_gauge       = _last_response_time_guage      .labels(resource_id)
         self.resource_request_counter       = _resource_request_counter      .labels(resource_id)
         self.request_slot_acquire_durations = _request_slot_acquire_durations.labels(resource_id)
-        self.semaphore = asyncio.Semaphore(config.get_int(f'{resource_id}__max_active_requests'))
+        self.max_active_requests = config.get_int(f'{resource_id}__max_active_requests')
+        self.peak_active_requests_count = 0  # these 3 are reset each adaptive_interval
+        self.latency_samples_count      = 0
+        self.latency_sum                = 0.0
+        self.request_limit_gauge = _request_limit_gauge.labels(resource_id)
+        self.request_limit_gauge.set(self.max_active_requests)
+        self.request_classes = {name: _RequestClass(resource_id, name, weight)
+                                for name, weight in _config_pairs('request_classes', positive=True).items()}
+        self.virtual_time = 0.0  # pass of the class that was granted the last slot
         # initialize children for metrics that have more than one label
         _request_slot_error_counter.labels(resource_id, 'timeout')
         _request_slot_error_counter.labels(resource_id, 'overload')
+        deadlines.init_metric_children(resource_id)
+        for direction in ('increase', 'decrease'):
+            _request_limit_adjustments_counter.labels(resource_id, direction)
+        for window in ('sample', 'baseline'):
+            _request_limit_latency_gauge.labels(resource_id, window)
 
     async def acquire_slot(self):
+        ''' Acquires a slot for the request class in request_class_var (the first class if it is
+            not set, e.g., for background tasks) and returns the class, which must be passed to
+            release_slot(). There are no awaits between checking and updating the counts and
+            queues, so no lock is needed. '''
         self.last_request_time_gauge.set_to_current_time()
         self.resource_request_counter.inc()
         if shutdown_event.is_set():
             raise asyncio.CancelledError('server is shutting down')
-        max_pending_requests = config.get_int(f'{self.resource_id}__max_pending_requests')
-        async with self.lock:
-            if self.pending_requests_count == max_pending_requests:
-                msg = f'too many pending requests'
-                _request_slot_error_counter.labels(self.resource_id, 'overload').inc()
-                raise ResourceError(f'{msg} for resource {self.resource_id}', log_msg=msg,
-                    log_kv_pairs=f'resource_id={self.resource_id} {max_pending_requests=!s}')
-            self.pending_requests_count += 1
-            self.pending_requests_gauge.inc()
+        req_class = (self.request_classes.get(request_class_var.get()) or
+                     next(iter(self.request_classes.values())))
+        max_pending_requests = _config_pairs(f'{self.resource_id}__request_class_max_pending').get(
+            req_class.name, config.get_int(f'{self.resource_id}__max_pending_requests'))
+        deadlines.admit(self.resource_id, 'slot')
+        if req_class.pending_requests_count >= max_pending_requests:
+            msg = f'too many pending {req_class.name} requests'
+            _request_slot_error_counter.labels(self.resource_id, 'overload').inc()
+            _class_request_slot_error_counter.labels(self.resource_id, req_class.name, 'overload').inc()
+            raise ResourceError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+                log_kv_pairs=f'resource_id={self.resource_id} request_class={req_class.name} '
+                             f'max_pending_requests={max_pending_requests:g}')
+        self._add_pending(req_class, 1)
         acquired   = False
+        waiter     = None
         start_time = time.monotonic()
-        timeout    = config.get_int(f'{self.resource_id}__request_slot_timeout')
+        timeout    = _config_pairs(f'{self.resource_id}__request_class_slot_timeouts').get(
+            req_class.name, config.get_int(f'{self.resource_id}__request_slot_timeout'))
+        timeout    = deadlines.bounded_timeout(timeout)
         try:
-            await asyncio.wait_for(self.semaphore.acquire(), timeout)
-            self.request_slot_acquire_durations.observe(time.monotonic() - start_time)
+            if self.active_requests_count < self.max_active_requests and not self._backlogged():
+                self._grant(req_class)
+            else:
+                if not req_class.waiters:  # the class was idle, so it must not bank its unused share
+                    req_class.pass_ = max(req_class.pass_, self.virtual_time)
+                waiter = asyncio.get_running_loop().create_future()
+                req_class.waiters.append(waiter)
+                await asyncio.wait_for(waiter, timeout)
             acquired = True
+            duration = time.monotonic() - start_time
+            self.request_slot_acquire_durations.observe(duration)
+            req_class.request_slot_acquire_durations.observe(duration)
+            deadlines.observe(self.resource_id, 'slot', duration)
+            return req_class.name
         except asyncio.TimeoutError as e:
-            msg = f'{timeout}-sec timeout waiting for a request slot'
+            deadlines.observe(self.resource_id, 'slot', time.monotonic() - start_time)
+            msg = f'{timeout:g}-sec timeout waiting for a request slot'
             _request_slot_error_counter.labels(self.resource_id, 'timeout').inc()
+            _class_request_slot_error_counter.labels(self.resource_id, req_class.name, 'timeout').inc()
             raise AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
-                    log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+                    log_kv_pairs=f'resource_id={self.resource_id} request_class={req_class.name} {format_exc(e)}')
         finally:
-            async with self.lock:
-                self.pending_requests_count -= 1
-                self.pending_requests_gauge.dec()
-                if acquired:
-                    self.active_requests_count += 1
-                    self.in_progress_requests_gauge.inc()
-
-    async def release_slot(self):
-        async with self.lock:
-            self.active_requests_count -= 1
-            self.in_progress_requests_gauge.dec()
-        self.semaphore.release()
+            if waiter and not acquired:  # timed out or cancelled
+                if waiter.done() and not waiter.cancelled():
+                    self._release(req_class)  # the slot was granted just before, so pass it on
+                else:
+                    waiter.cancel()
+                    if waiter in req_class.waiters:
+                        req_class.waiters.remove(waiter)
+                    self._add_pending(req_class, -1)
+
+    async def release_slot(self, request_class:str):
+        self._release(self.request_classes[request_class])
         self.last_response_time_gauge.set_to_current_time()
+
+    def record_query_duration(self, duration:float):
+        'called by Query for each query it runs, for the adaptive limiter'
+        self.latency_samples_count += 1
+        self.latency_sum           += duration
+
+    async def adapt_limit(self):
+        ''' This background task/coroutine adjusts max active requests when
+            <resource_id>__adaptive_concurrency is enabled, from the query latency, with a gradient
+            algorithm (like Netflix's gradient2). Every adaptive_interval seconds, the average query
+            latency is compared with a baseline: the 10th percentile of the averages of the last
+            adaptive_baseline_intervals intervals, so a few intervals that only ran quick queries
+            do not pin it low, and a sustained rise in latency takes most of that window to raise
+            it. While latency is within adaptive_latency_tolerance times the baseline, the limit
+            grows by about sqrt(limit), if at least half of it was in use; once latency climbs
+            beyond that--e.g., because queries are queueing inside the database--the limit is
+            multiplied by the gradient:
+                gradient = max(0.5, adaptive_latency_tolerance * baseline / latency)
+            The limit starts at adaptive_min_active_requests, so the baseline is measured before
+            the database queues any queries, and it is kept between that and max_active_requests. '''
+        task_name = f'{BACKGROUND_TASK_NAME_PREFIX}-{self.resource_id}-adaptive-limit'
+        asyncio.current_task().set_name(task_name)
+        log.info('task-running', f'task {task_name} is running')
+        rid       = self.resource_id
+        limit     = None
+        latencies = collections.deque()  # the average latency of each recent interval
+        while not shutdown_event.is_set():
+            await asyncio.sleep(config.get_float(f'{rid}__adaptive_interval'))
+            try:
+                samples_count, latency_sum = self.latency_samples_count, self.latency_sum
+                peak_active_requests_count = self.peak_active_requests_count
+                self.latency_samples_count, self.latency_sum = 0, 0.0
+                self.peak_active_requests_count = self.active_requests_count
+                max_limit = config.get_int(f'{rid}__max_active_requests')
+                if not config.getbool(f'{rid}__adaptive_concurrency'):
+                    limit = None
+                    latencies.clear()
+                    self.set_max_active_requests(max_limit)  # the static limit
+                    continue
+                min_limit = config.get_int(f'{rid}__adaptive_min_active_requests')
+                if limit is None:
+                    limit = min_limit  # just enabled (or started), the latency samples are not used
+                elif samples_count:
+                    latency = latency_sum / samples_count
+                    latencies.append(latency)
+                    while len(latencies) > max(config.get_int(f'{rid}__adaptive_baseline_intervals'), 1):
+                        latencies.popleft()
+                    baseline  = sorted(latencies)[int((len(latencies) - 1) * _BASELINE_PERCENTILE)]
+                    gradient  = config.get_float(f'{rid}__adaptive_latency_tolerance') * baseline / max(latency, 1e-6)
+                    if gradient >= 1:
+                        probe     = math.sqrt(limit) if peak_active_requests_count >= limit / 2 else 0
+                        new_limit = limit + probe
+                    else:
+                        new_limit = limit * max(gradient, 0.5)
+                    limit     = limit + _LIMIT_SMOOTHING * (new_limit - limit)
+                    limit     = min(max(limit, min_limit), max_limit)
+                    _request_limit_latency_gauge.labels(rid, 'sample')  .set(latency)
+                    _request_limit_latency_gauge.labels(rid, 'baseline').set(baseline)
+                else:
+                    limit = min(limit, max_limit)  # idle; keep the limit
+                self.set_max_active_requests(math.floor(limit))
+            except Exception as e:
+                # e.g., a bad config value; keep the current limit and try again next interval
+                log.error('task-exc', f'background task {task_name} exception: {e}', exc_info=True)
+
+    def set_max_active_requests(self, max_active_requests:int):
+        'if the limit is raised, waiting requests get the new slots; if it is lowered, active requests drain'
+        if max_active_requests == self.max_active_requests:
+            return
+        direction = 'increase' if max_active_requests > self.max_active_requests else 'decrease'
+        _request_limit_adjustments_counter.labels(self.resource_id, direction).inc()
+        self.max_active_requests = max_active_requests
+        self.request_limit_gauge.set(max_active_requests)
+        self._dispatch()
+
+    def _backlogged(self):
+        return any(req_class.waiters for req_class in self.request_classes.values())
+
+    def _add_pending(self, req_class:_RequestClass, count:int):
+        self.pending_requests_count      += count
+        req_class.pending_requests_count += count
+        self.pending_requests_gauge.inc(count)
+        req_class.pending_requests_gauge.inc(count)
+
+    def _grant(self, req_class:_RequestClass):
+        self._add_pending(req_class, -1)
+        self.active_requests_count += 1
+        self.peak_active_requests_count = max(self.peak_active_requests_count, self.active_requests_count)
+        self.in_progress_requests_gauge.inc()
+        req_class.in_progress_requests_gauge.inc()
+
+    def _release(self, req_class:_RequestClass):
+        self.active_requests_count -= 1
+        self.in_progress_requests_gauge.dec()
+        req_class.in_progress_requests_gauge.dec()
+        self._dispatch()
+
+    def _dispatch(self):
+        'grants free slots to waiting requests, picking the class per request_class_policy'
+        priority = config.get('request_class_policy') == 'priority'
+        while self.active_requests_count < self.max_active_requests:
+            backlogged = [req_class for req_class in self.request_classes.values() if req_class.waiters]
+            if not backlogged:
+                return
+            req_class = backlogged[0] if priority else min(backlogged, key=lambda c: c.pass_)
+            waiter    = req_class.waiters.popleft()
+            if waiter.done():
+                continue  # cancelled; its request removes itself from the pending counts
+            self.virtual_time = req_class.pass_
+            req_class.pass_  += 1 / req_class.weight
+            self._grant(req_class)
+            waiter.set_result(None)
@@ -17,13 +17,29 @@ class AcquiredResources:
     def __init__(self, resource_id: str):
         self.resource_id               = resource_id
         self.request_slot_acquired     = False
+        self.request_class             = None  # set when the request slot is acquired
         self.db_conn: BaseDbConnection = None
 
+    async def acquire(self):
+        ''' Acquires the request slot and DB connection, if they have not been acquired yet
+            (see acquire_resources(lazy=True)), or raises a FastAPI HTTPException. '''
+        if not self.db_conn:
+            await resource_manager.acquire_resource(self, self.release)
+
     async def release(self):
         await resource_manager.release_resources(self)
         self.db_conn               = None
         self.request_slot_acquired = False
 
+    async def release_early(self):
+        ''' Releases the resources now, rather than after the response has been sent, if
+            <resource_id>__release_resources_early is enabled. A slow client then does not
+            hold a pooled connection and a request slot while it reads the response body.
+            Only call this after the query results have been materialized--i.e., not when
+            the results are streamed from the DB cursor. '''
+        if config.getbool(f'{self.resource_id}__release_resources_early'):
+            await self.release()
+
     def __del__(self):
         if self.db_conn or self.request_slot_acquired:
             raise RuntimeError(f'resources were not released for {self.resource_id}')
@@ -67,23 +83,31 @@ class ResourceManager:
                     raise ValueError('unsupported db_type')
             self.request_limiters[resource_id] = RequestLimiter(resource_id)
 
-    async def check_db_connections(self):
-        for pool in self.db_connection_pools.values():
-            await pool.check_connections()
-
-    def create_db_connection_pool_background_tasks(self):
+    def create_resource_background_tasks(self):
         for pool in self.db_connection_pools.values():
             asyncio.create_task(pool.create_connections())
+            asyncio.create_task(pool.autoscale())
+            asyncio.create_task(pool.expire_connections())
+            asyncio.create_task(pool.share_connection_budget())
+            asyncio.create_task(pool.keepalive_connections())
+        for request_limiter in self.request_limiters.values():
+            asyncio.create_task(request_limiter.adapt_limit())
     
     async def close_db_connections(self):
         for pool in self.db_connection_pools.values():
             await pool.close_connections()
 
-    def acquire_resources(self, resource_ids: list[str]):
+    def acquire_resources(self, resource_ids: list[str], lazy=False):
         ''' This is a FastAPI dependency injection function.
             https://fastapi.tiangolo.com/tutorial/dependencies/
             A dict of AcquiredResources is returned or a FastAPI HTTPException is raised.
-            After the yield statement, the resources are released. '''
+            After the yield statement, the resources are released.
+            If lazy is True, the request slot and DB connection are not acquired until the route
+            handler calls AcquiredResources.acquire()--e.g., only if the query results are not
+            cached. Only one resource_id is allowed then, since acquiring the resources of several
+            resource_ids one at a time, in route handler order, could deadlock. '''
+        if lazy and len(resource_ids) > 1:
+            raise ValueError('lazy acquisition only supports one resource_id')
 
         async def dependency_coroutine():
             acquired_resources_dict: dict[str, AcquiredResources] = {}
@@ -93,51 +117,12 @@ class ResourceManager:
                     await resources.release()
 
             for resource_id in resource_ids:
-                start_time      = time.monotonic()
-                request_limiter = self.request_limiters.   get(resource_id)
-                pool            = self.db_connection_pools.get(resource_id)
-                if not request_limiter or not pool:
-                    raise HTTPException(404, get_cid(f'resource {resource_id} not found'))
-                # acquire a request slot
+                if resource_id not in self.request_limiters or resource_id not in self.db_connection_pools:
+                    raise HTTPException(404, f'resource {resource_id} not found')
                 acquired_resources = AcquiredResources(resource_id)
                 acquired_resources_dict[resource_id] = acquired_resources
-                try:
-                    await request_limiter.acquire_slot()
-                    acquired_resources.request_slot_acquired = True
-                    set_duration(resource_id, 'request_slot', round(time.monotonic() - start_time, 3))
-                except asyncio.CancelledError:
-                    await release_any_resources()
-                    msg = 'request was cancelled due to shutdown of service'
-                    log.error('shutdown-cancel', msg, resource_id=f'{resource_id}', cid=get_cid())
-                    raise HTTPException(503, get_cid(msg))  # 503 = service unavailable
-                except AppTimeoutError as e:
-                    await release_any_resources()
-                    log.error('slot-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
-                    raise HTTPException(504, get_cid(f'{e}'))  # 504 = gateway timeout
-                except ResourceError as e:
-                    await release_any_resources()
-                    log.error('slot-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
-                    raise HTTPException(429, get_cid(f'{e}'))  # 429 = too many requests
-                except Exception as e:
-                    await release_any_resources()
-                    msg = f'unable to obtain a request slot for resource {resource_id}'
-                    log.error('slot-err', msg, cid=get_cid(), exception=f'{format_exc(e)}')
-                    raise HTTPException(500, get_cid(msg))  # 500 = internal server error
-                # acquire a DB connection
-                start_time = time.monotonic()
-                try:
-                    conn = await pool.acquire_connection()
-                    acquired_resources.db_conn = conn
-                    set_duration(resource_id, 'db_connection', round(time.monotonic() - start_time, 3))
-                except AppTimeoutError as e:
-                    await release_any_resources()
-                    log.error('dbconn-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
-                    raise HTTPException(504, get_cid(f'{e}'))
-                except Exception as e:
-                    await release_any_resources()
-                    msg = f'unable to obtain a database connection for resource {resource_id}'
-                    log.error('slot-err', msg, cid=get_cid(), exception=f'{format_exc(e)}')
-                    raise HTTPException(500, get_cid(msg))
+                if not lazy:
+                    await self.acquire_resource(acquired_resources, release_any_resources)
             try:  # this is needed in case the route handler raises an exception
                 yield acquired_resources_dict  # code after this will run after the route handler finishes
             # let any exceptions raised by the route handler propagate up and be handled in
@@ -146,11 +131,58 @@ class ResourceManager:
                 await release_any_resources()
         return dependency_coroutine
 
+    async def acquire_resource(self, acquired_resources: AcquiredResources, release_any_resources):
+        ''' Acquires a request slot and then a DB connection for acquired_resources.resource_id.
+            If either cannot be acquired, release_any_resources() is awaited and a FastAPI
+            HTTPException is raised. '''
+        resource_id     = acquired_resources.resource_id
+        start_time      = time.monotonic()
+        request_limiter = self.request_limiters[resource_id]
+        pool            = self.db_connection_pools[resource_id]
+        # acquire a request slot
+        try:
+            acquired_resources.request_class = await request_limiter.acquire_slot()
+            acquired_resources.request_slot_acquired = True
+            set_duration(resource_id, 'request_slot', round(time.monotonic() - start_time, 3))
+        except asyncio.CancelledError:
+            await release_any_resources()
+            msg = 'request was cancelled due to shutdown of service'
+            log.error('shutdown-cancel', msg, resource_id=f'{resource_id}', cid=get_cid())
+            raise HTTPException(503, msg)  # 503 = service unavailable
+        except AppTimeoutError as e:
+            await release_any_resources()
+            log.error('slot-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            raise HTTPException(504, f'{e}')  # 504 = gateway timeout
+        except ResourceError as e:
+            await release_any_resources()
+            log.error('slot-err', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            raise HTTPException(429, f'{e}')  # 429 = too many requests
+        except Exception as e:
+            await release_any_resources()
+            msg = f'unable to obtain a request slot for resource {resource_id}'
+            log.error('slot-err', msg, cid=get_cid(), exception=f'{format_exc(e)}')
+            raise HTTPException(500, msg)  # 500 = internal server error
+        # acquire a DB connection
+        start_time = time.monotonic()
+        try:
+            conn = await pool.acquire_connection()
+            acquired_resources.db_conn = conn
+            set_duration(resource_id, 'db_connection', round(time.monotonic() - start_time, 3))
+        except AppTimeoutError as e:
+            await release_any_resources()
+            log.error('dbconn-timeout', e.log_msg, **parse_kv_pairs(e.log_kv_pairs), cid=get_cid())
+            raise HTTPException(504, f'{e}')
+        except Exception as e:
+            await release_any_resources()
+            msg = f'unable to obtain a database connection for resource {resource_id}'
+            log.error('slot-err', msg, cid=get_cid(), exception=f'{format_exc(e)}')
+            raise HTTPException(500, msg)
+
     async def release_resources(self, resources: AcquiredResources):
         # release the DB connection, if any, first
         if resources.db_conn:
             await self.db_connection_pools[resources.resource_id].release_connection(resources.db_conn)
         if resources.request_slot_acquired:
-            await self.request_limiters[resources.resource_id].release_slot()
+            await self.request_limiters[resources.resource_id].release_slot(resources.request_class)
 
 resource_manager = ResourceManager()
@@ -1,4 +1,4 @@
-import asyncio
+import asyncio, datetime
 from   collections       import defaultdict
 from   contextvars       import ContextVar
 from   prometheus_client import Counter, Histogram, Summary
@@ -7,6 +7,9 @@ BACKGROUND_TASK_NAME_PREFIX = 'background-task'
 
 cid_var               = ContextVar('correlation-id',    default='')
 acquire_durations_var = ContextVar('acquire-durations', default=defaultdict(dict))
+request_class_var     = ContextVar('request-class',     default='')  # see request_limiter.request_class()
+deadline_var          = ContextVar('deadline',          default=None)  # see deadlines.py
+route_var             = ContextVar('route',             default=None)  # request path, see deadlines.py
 shutdown_event        = asyncio.Event()
 sigusr1_received      = asyncio.Event()
 
@@ -26,13 +29,30 @@ request_duration_hist = Histogram('wt_request_duration_seconds', 'duration to se
     buckets=[0.001, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60])
 request_duration_summary = Summary('wt_request_duration_summary_seconds', 'duration to service a request',
     ['endpoint', 'status_code'])
+response_send_duration_hist = Histogram('wt_response_send_duration_seconds',
+    'duration to send the response body, after the route handler returned', ['endpoint'],
+    # you may want to adjust the buckets
+    buckets=[0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60])
+
+# compression ratio = rate(wt_compression_in_bytes_total) / rate(wt_compression_out_bytes_total)
+compression_cpu_counter       = Counter('wt_compression_cpu_seconds_total',
+    'CPU time spent compressing response bodies', ['endpoint', 'encoding'])
+compression_in_bytes_counter  = Counter('wt_compression_in_bytes_total',
+    'response body bytes before compression', ['endpoint', 'encoding'])
+compression_out_bytes_counter = Counter('wt_compression_out_bytes_total',
+    'response body bytes after compression', ['endpoint', 'encoding'])
 
 def init_endpoint_metric_children(endpoints: list[str]):
      for endpoint in endpoints:
         request_counter      .labels(endpoint)
         request_duration_hist.labels(endpoint)
+        response_send_duration_hist.labels(endpoint)
         for status_code in '2xx 4xx 5xx'.split():
             request_duration_summary.labels(endpoint, status_code)
+        for encoding in 'gzip zstd'.split():
+            compression_cpu_counter      .labels(endpoint, encoding)
+            compression_in_bytes_counter .labels(endpoint, encoding)
+            compression_out_bytes_counter.labels(endpoint, encoding)
 
 # some database drivers return datetime objects and likely need to be converted
 def convert_datetime_to_str(data, datetime_col, format='%Y-%m-%d %H:%M:%S'):
@@ -48,3 +68,18 @@ def convert_timestamp_to_str(df, timestamp_col, format='%Y-%m-%d %H:%M:%S'):
     "converts panda's Timestamp objects to strings"
     df[timestamp_col] = df[timestamp_col].dt.strftime(format)
     return df
+
+def sql_literal(value):
+    ''' formats a Python value as an SQL literal; only use this for values that are computed by the
+        service (e.g., a time window boundary), never for values that are supplied by clients '''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, int, float)):
+        return str(int(value) if isinstance(value, bool) else value)
+    if isinstance(value, datetime.datetime):
+        # microseconds are kept if there are any, e.g., so a keyset pagination key does not match
+        # (and skip or repeat) the other rows of the same second
+        value = value.strftime('%Y-%m-%d %H:%M:%S.%f' if value.microsecond else '%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, datetime.date):
+        value = value.strftime('%Y-%m-%d')
+    return "'" + str(value).replace("'", "''") + "'"
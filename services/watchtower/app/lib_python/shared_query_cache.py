@@ -0,0 +1,153 @@
+''' A query result cache that is shared by all of the gunicorn workers on the host, so a result
+    cached by one worker is a hit for the others. Each entry is a file in query_cache_shared_dir
+    (by default on /dev/shm, i.e., in memory) that holds the already encoded results (bytes), so a
+    hit is sent as is. An entry is written to a temporary file that is then renamed, which is
+    atomic, so readers never see a partially written entry and do not take a lock. Writers hold an
+    exclusive file lock (flock) while they rename an entry into place and update the total size of
+    the entries, which is kept in the lock file. Only when the total goes over
+    query_cache_shared_max_bytes (or is not known, e.g., after a restart) are the entries scanned,
+    and then they are evicted down to 90% of the max, so the next puts do not scan again: expired
+    entries first, then the least recently used (a hit updates the entry's mtime). An entry is only
+    considered expired once it has also been stale for query_cache_stale_ttl secs. The methods do
+    blocking file I/O, so async code should call them with asyncio.to_thread(). '''
+import fcntl, hashlib, os, struct, tempfile, time
+from   prometheus_client import Gauge
+from   . import config
+
+_HEADER            = struct.Struct('<dq')  # expiry time (time.time()), row count (-1 if unknown)
+_TOTAL             = struct.Struct('<q')   # total bytes of the entries, in the lock file
+_TMP_PREFIX        = '.tmp-'
+_STALE_TMP_AGE     = 60   # secs; temp files this old were left behind by a worker that died mid-write
+_EVICT_TO          = 0.9  # evictions free space down to this fraction of query_cache_shared_max_bytes
+_shared_bytes_gauge = Gauge('wt_query_cache_shared_bytes', 'bytes of query results in the shared cache',
+                            multiprocess_mode='mostrecent')
+
+class SharedQueryCache:
+    def __init__(self):
+        self.created_dirs = set()
+
+    @staticmethod
+    def enabled():
+        return config.get_eval('query_cache_shared_max_bytes') > 0
+
+    def _dir(self):
+        path = config.get('query_cache_shared_dir')
+        if path not in self.created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+        return path
+
+    def _path(self, key:tuple):
+        # the resource_id prefix lets evictions be counted per resource_id
+        return os.path.join(self._dir(), f'{key[0]}-{hashlib.sha256(repr(key).encode()).hexdigest()[:32]}')
+
+    def get(self, key:tuple, stale_ttl=0):
+        'returns (results, row_count, stale) for an entry that has not expired or is stale, or None'
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        expiry_time, row_count = _HEADER.unpack_from(data)
+        now = time.time()
+        if expiry_time + stale_ttl <= now:
+            return None  # removed by the next eviction that needs the space
+        try:
+            os.utime(path)  # marks the entry as recently used
+        except FileNotFoundError:
+            pass  # evicted by another worker after it was read
+        return data[_HEADER.size:], (None if row_count < 0 else row_count), expiry_time <= now
+
+    def put(self, key:tuple, results:bytes, row_count, ttl:float, stale_ttl=0):
+        ''' Caches results for ttl secs and returns the resource_ids of the entries that were
+            evicted. Results larger than query_cache_shared_max_bytes are not cached. '''
+        max_bytes = config.get_eval('query_cache_shared_max_bytes')
+        size      = _HEADER.size + len(results)
+        if size > max_bytes:
+            return []
+        cache_dir    = self._dir()
+        path         = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(time.time() + ttl, -1 if row_count is None else row_count))
+                f.write(results)
+            with open(os.path.join(cache_dir, '.lock'), 'a+b') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+                # the entry is replaced with the lock held, so the size it replaces is known
+                replaced_size = self._size(path)
+                os.replace(tmp_path, path)
+                lock_file.seek(0)
+                data    = lock_file.read()
+                total   = _TOTAL.unpack(data)[0] + size - replaced_size if len(data) == _TOTAL.size else None
+                evicted = []
+                if total is None or total > max_bytes:
+                    total, evicted = self._evict(cache_dir, max_bytes, stale_ttl)
+                lock_file.truncate(0)
+                lock_file.write(_TOTAL.pack(total))  # 'a' mode, so this writes at offset 0
+        except BaseException:
+            self._unlink(tmp_path)
+            raise
+        _shared_bytes_gauge.set(total)
+        return evicted
+
+    def _evict(self, cache_dir, max_bytes, stale_ttl):
+        ''' scans the entries and, if they total more than max_bytes, evicts entries until they
+            total at most _EVICT_TO x max_bytes; returns (total, resource_ids of the evicted entries).
+            The caller must hold the lock. '''
+        now, entries, total = time.time(), [], 0
+        for entry in os.scandir(cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(_TMP_PREFIX):
+                if stat.st_mtime < now - _STALE_TMP_AGE:
+                    self._unlink(entry.path)
+                continue
+            if entry.name.startswith('.'):
+                continue
+            entries.append((stat.st_mtime, entry.path, entry.name, stat.st_size))
+            total += stat.st_size
+        evicted = []
+        if total > max_bytes:
+            target  = max_bytes * _EVICT_TO
+            expired = set()
+            for _, path, _, size in entries:
+                if self._expired(path, stale_ttl):
+                    expired.add(path)
+                    total -= size if self._unlink(path) else 0
+            for _, path, name, size in sorted(entries):  # least recently used first
+                if total <= target:
+                    break
+                if path not in expired and self._unlink(path):
+                    total -= size
+                    evicted.append(name.rpartition('-')[0])
+        return total, evicted
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _expired(path, stale_ttl):
+        try:
+            with open(path, 'rb') as f:
+                expiry_time, _ = _HEADER.unpack(f.read(_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return False
+        return expiry_time + stale_ttl <= time.time()
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+shared_query_cache = SharedQueryCache()
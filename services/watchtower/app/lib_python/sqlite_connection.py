@@ -5,10 +5,18 @@ from   .base_db_connection import BaseDbConnection
 from   . import config
 
 class SqliteConnection(BaseDbConnection):
+    _PROGRESS_HANDLER_STEPS = 10000  # SQLite VM instructions between calls to _progress_handler()
+
+    def __init__(self, resource_id: str):
+        super().__init__(resource_id)
+        self.deadline_mono = None   # when the running statement times out, if enforced by SQLite
+        self.interrupted   = False  # True if the current query was interrupted after a client-side timeout
+
     async def open(self, conn_params: dict, timeout=None):
         timeout = timeout or config.get_int(f'{self.resource_id}__db_conn_timeout')
         try:
             self.conn    = await asyncio.wait_for(aiosqlite.connect(conn_params['database']), timeout)
+            await self.conn.set_progress_handler(self._progress_handler, self._PROGRESS_HANDLER_STEPS)
             self.is_open = True
             await self.set_id()
         except asyncio.TimeoutError as e:
@@ -31,6 +39,40 @@ class SqliteConnection(BaseDbConnection):
         await self.conn.close()
         self.is_open = False
 
+    async def _ping(self):
+        async with self.conn.execute('SELECT 1') as cursor:
+            await cursor.fetchone()
+
+    def _progress_handler(self):
+        ''' runs in the aiosqlite thread while a statement runs; returning True makes SQLite abort
+            the statement, which then raises an "interrupted" error '''
+        return self.deadline_mono is not None and time.monotonic() > self.deadline_mono
+
+    def _set_deadline(self, timeout):
+        self.deadline_mono = time.monotonic() + timeout if self.server_side_timeouts() else None
+
+    async def _interrupt(self):
+        ''' aborts the running statement, e.g., after the client-side timeout; sqlite3's interrupt()
+            is meant to be called from another thread, so it does not wait for the aiosqlite thread '''
+        await self.conn.interrupt()
+        self.interrupted = True
+        self.server_aborts_counter.inc()
+
+    async def _wait(self, aw, timeout):
+        ''' awaits aw, a call that runs in the aiosqlite thread, for up to timeout secs; if it times
+            out, the statement is still running in that thread, so it is interrupted '''
+        try:
+            return await asyncio.wait_for(aw, max(timeout, 0))
+        except asyncio.TimeoutError:
+            await self._interrupt()
+            raise
+
+    def _server_abort_error(self, timeout, e):
+        self.server_aborts_counter.inc()
+        msg = f'{timeout}-sec timeout, DB query aborted by SQLite'
+        return AppTimeoutError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+            log_kv_pairs=f'resource_id={self.resource_id} server_side_abort=true {format_exc(e)}')
+
     _keep_connection_open_errors = ('syntax error', 'no such column', 'no such table')
     async def execute_query(self, query:str, results_as='psv', header=False, timeout=None):
         ''' results_as  value     return type
@@ -38,11 +80,16 @@ class SqliteConnection(BaseDbConnection):
                         json      list[dict]
                         psv       StringIO buffer '''
         timeout    = timeout or config.get_int(f'{self.resource_id}__db_default_query_timeout')
+        client_timeout = self.client_timeout(timeout)
         cursor     = None
         start_time = time.monotonic()
+        self.interrupted = False
         try:
-            cursor  = await asyncio.wait_for(self.conn.execute(query), timeout)
-            rows    = await asyncio.wait_for(cursor.fetchall(),        timeout)
+            # one deadline for the execute and the fetch, on both the SQLite and the client side
+            self._set_deadline(timeout)
+            client_deadline = start_time + client_timeout
+            cursor  = await self._wait(self.conn.execute(query), client_deadline - time.monotonic())
+            rows    = await self._wait(cursor.fetchall(),        client_deadline - time.monotonic())
             columns = [column[0] for column in cursor.description]
 
             ## DEBUG random delay to simulate a slow query
@@ -58,14 +105,16 @@ class SqliteConnection(BaseDbConnection):
                 case _:
                     raise ValueError(f'unsupported {results_as=!s}')
         except asyncio.TimeoutError as e:
-            if cursor:
-                await cursor.cancel()  # attempt to cancel the query
+            # _wait() interrupted the statement, so it does not keep running in the aiosqlite thread
             msg = f'{timeout}-sec timeout waiting for DB query or fetch'
             raise AppTimeoutError(f'{msg} from resource {self.resource_id}', log_msg=msg,
-                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+                log_kv_pairs=f'resource_id={self.resource_id} '
+                             f'server_side_abort={str(self.interrupted).lower()} {format_exc(e)}')
         except aiosqlite.Error as e:
             msg = f'DB query error'
             err = str(e)
+            if err == 'interrupted':  # by _progress_handler()
+                raise self._server_abort_error(timeout, e)
             if any (e in err for e in self._keep_connection_open_errors):
                 conn_details = f', keeping connection {self.conn_id} open'
                 ##msg += f': {err}'  # maybe okay to show this DB error to the user?
@@ -79,9 +128,63 @@ class SqliteConnection(BaseDbConnection):
             raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
                 log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
         finally:
+            self.deadline_mono = None
             if cursor:
                 await cursor.close()
             self.usage_duration += round(time.monotonic() - start_time, 3)
         msg = f'DB query error'
         raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
             log_kv_pairs=f'resource_id={self.resource_id}')
+
+    async def fetch_batches(self, query:str, batch_size=None, timeout=None):
+        ''' async generator that yields (columns, rows) tuples, up to batch_size rows at a time;
+            timeout applies to the query (including the first fetch) and to each later fetch. It
+            does not run while a batch is sent, since the statement then sits idle. '''
+        batch_size = batch_size or config.get_int(f'{self.resource_id}__db_fetch_batch_size')
+        timeout    = timeout    or config.get_int(f'{self.resource_id}__db_default_query_timeout')
+        client_timeout = self.client_timeout(timeout)
+        cursor     = None
+        start_time = time.monotonic()
+        self.interrupted = False
+        try:
+            self._set_deadline(timeout)
+            client_deadline = start_time + client_timeout
+            cursor  = await self._wait(self.conn.execute(query),        client_deadline - time.monotonic())
+            columns = [column[0] for column in cursor.description]
+            rows    = await self._wait(cursor.fetchmany(batch_size), client_deadline - time.monotonic())
+            self.deadline_mono = None  # no statement runs while the batch is sent
+            yield columns, rows
+            while len(rows) == batch_size:
+                self._set_deadline(timeout)
+                rows = await self._wait(cursor.fetchmany(batch_size), client_timeout)
+                self.deadline_mono = None
+                if rows:
+                    yield columns, rows
+        except asyncio.TimeoutError as e:
+            # _wait() interrupted the statement, unless the timeout came from elsewhere (e.g., thrown
+            # into the generator while a batch was sent), when no statement was running
+            msg = f'{timeout}-sec timeout waiting for DB query or fetch'
+            raise AppTimeoutError(f'{msg} from resource {self.resource_id}', log_msg=msg,
+                log_kv_pairs=f'resource_id={self.resource_id} '
+                             f'server_side_abort={str(self.interrupted).lower()} {format_exc(e)}')
+        except aiosqlite.Error as e:
+            msg = f'DB query error'
+            err = str(e)
+            if err == 'interrupted':  # by _progress_handler()
+                raise self._server_abort_error(timeout, e)
+            if any (e in err for e in self._keep_connection_open_errors):
+                conn_details = f', keeping connection {self.conn_id} open'
+            else:
+                await self.close()
+                conn_details = f', connection {self.conn_id} closed'
+            raise DatabaseError(f'{msg} for resource {self.resource_id}', log_msg=f'{msg}{conn_details}',
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        except Exception as e:
+            msg = f'DB query error'
+            raise WithDetailsError(f'{msg} for resource {self.resource_id}', log_msg=msg,
+                log_kv_pairs=f'resource_id={self.resource_id} {format_exc(e)}')
+        finally:
+            self.deadline_mono = None
+            if cursor and self.is_open:
+                await cursor.close()
+            self.usage_duration += round(time.monotonic() - start_time, 3)
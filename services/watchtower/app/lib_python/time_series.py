@@ -0,0 +1,92 @@
+''' Materialized windows of append-only time-series tables--e.g., tcp_hourly, keyed by date_hour.
+    The rows of a window are kept in memory (per worker), in time order. Each refresh only fetches
+    the rows at or after the latest time seen--the latest time bucket is fetched again, in case rows
+    were still being added to it--and rows that fall before the window start are trimmed. So a poll
+    reads O(new rows) from the database rather than O(window). One window is kept per query, as
+    long as the longest window requested, and shorter windows are served from its newest rows. '''
+import asyncio, bisect
+from   .dataframes import DataFrameBuilder
+from   .encoders   import json_dumps, json_encode_rows
+from   .shared     import sql_literal
+
+class TimeSeriesWindow:
+    def __init__(self, query:str, time_column:str):
+        self.query       = query
+        self.time_column = time_column
+        self.columns     = None
+        self.rows        = []    # row tuples, sorted by time
+        self.time_index  = None  # index of time_column in each row
+        self.window      = None  # the longest window requested, which the rows cover (a timedelta)
+        self.lock        = asyncio.Lock()  # one refresh at a time
+        self.refreshed_time_mono = 0
+        self.encoded     = {}    # (results_as, index of the first row) -> results, cleared when the rows change
+
+    def latest_time(self):
+        return self.rows[-1][self.time_index] if self.rows else None
+
+    def extend_window(self, window):
+        ''' makes the window at least window long; since the older rows that a longer window needs
+            were not fetched, the rows are dropped and the next refresh fetches the whole window '''
+        if self.window is None or window > self.window:
+            self.window = window
+            self.rows   = []
+            self.encoded.clear()
+            self.refreshed_time_mono = 0
+
+    def delta_query(self, window_start):
+        'the query that fetches the rows that are not in the window yet'
+        since = self.latest_time()
+        if since is None or since < window_start:
+            since = window_start
+        return (f'SELECT * FROM ({self.query}) AS ts WHERE {self.time_column} >= {sql_literal(since)} '
+                f'ORDER BY {self.time_column}')
+
+    def update(self, columns, new_rows, window_start):
+        ''' replaces the rows of the latest time bucket with new_rows, which must be sorted by time,
+            and trims the rows that are older than window_start. The encoded results are only
+            dropped if the rows changed, since the latest bucket is usually re-read unchanged. '''
+        if self.columns is None:
+            self.columns    = columns
+            self.time_index = columns.index(self.time_column)
+        key     = lambda row: row[self.time_index]
+        changed = False
+        if new_rows:
+            tail = bisect.bisect_left(self.rows, key(new_rows[0]), key=key)
+            if self.rows[tail:] != new_rows:
+                del self.rows[tail:]
+                self.rows.extend(new_rows)
+                changed = True
+        if trim := bisect.bisect_left(self.rows, window_start, key=key):
+            del self.rows[:trim]
+            changed = True
+        if changed:
+            self.encoded.clear()
+
+    def first_index(self, window_start):
+        'the index of the first row that is in the window that starts at window_start'
+        if not self.rows:
+            return 0
+        return bisect.bisect_left(self.rows, window_start, key=lambda row: row[self.time_index])
+
+    def results(self, results_as:str, start=0, dtypes=None):
+        ''' the window's rows from index start on (see first_index()) as json_records or
+            json_columns (bytes) or as a dataframe; the results are reused until the rows change,
+            so they must not be modified in place '''
+        if (results_as, start) not in self.encoded:
+            rows = self.rows[start:] if start else self.rows
+            if results_as == 'dataframe':
+                builder = DataFrameBuilder(self.columns, dtypes, capacity=max(len(rows), 1))
+                builder.append(rows)
+                results = builder.to_dataframe()
+            elif results_as == 'json_records':
+                results = b'[' + json_encode_rows(rows, self.columns) + b']'
+            elif results_as == 'json_columns':
+                results = (b'{"columns":' + json_dumps(self.columns) + b',"rows":[' +
+                           json_encode_rows(rows) + b']}')
+            else:
+                raise ValueError(f'unsupported results_as: {results_as}')
+            self.encoded[(results_as, start)] = results
+        return self.encoded[(results_as, start)]
+
+# (resource_id, normalized query, time_column) -> TimeSeriesWindow
+windows: dict[tuple, TimeSeriesWindow] = {}